@@ -6,12 +6,19 @@ Created on Fri Jun  4 00:39:03 2021
 """
 
 import json
-import pandas as pd
+import time
 import pymongo
-from pymongo import MongoClient
 from iLox.objects.ilox_logger import iLoxLogger
-from iLox.dependencies.bulk_write import bulk_write
-from geopy.geocoders import Nominatim
+from iLox.dependencies.mongo_client import get_mongo_client
+from iLox.dependencies.merge_items import prep_merged_col, merge_items
+from iLox.dependencies.match_state import (
+    STAGE_EVENTS, STAGE_MERGED, complete_stage, prep_derived_fields)
+from iLox.dependencies.query_plan import check_query_plan
+from iLox.dependencies.item_dates import prep_dates
+from iLox.dependencies.gpe_cache import GPECache
+from iLox.dependencies.point_index import RefineryPointIndex
+from iLox.dependencies.refinery_registry import RefineryRegistry
+from iLox.dependencies.reverse_geocode_cache import ReverseGeocodeCache
 
 
 class iLox():
@@ -22,23 +29,24 @@ class iLox():
         self._get_params()
         self.ilox_logger = iLoxLogger(self.logging_params)
         print("Establishing MongoDb connections ...")
-        self.mycol_tweets =  MongoClient(
-            self.dbs_params["mongoDB_Host"], 
-            27017)[self.dbs_params["mongoDB_Db"]][self.dbs_params["mongoDB_Col_Tweets"]]
-        self.mycol_headlines =  MongoClient(
-            self.dbs_params["mongoDB_Host"], 
-            27017)[self.dbs_params["mongoDB_Db"]][self.dbs_params["mongoDB_Col_Headlines"]]
-        self.mycol_merged =  MongoClient(
-            self.dbs_params["mongoDB_Host"], 
-            27017)[self.dbs_params["mongoDB_Db"]][self.dbs_params["mongoDB_Col_Merged"]]
-        self.mycol_gpes =  MongoClient(
-            self.dbs_params["mongoDB_Host"], 
-            27017)[self.dbs_params["mongoDB_Db"]][self.dbs_params["mongoDB_Col_GPEs"]]
-        self.mycol_refineries =  MongoClient(
-            self.dbs_params["mongoDB_Host"], 
-            27017)[self.dbs_params["mongoDB_Db"]][self.dbs_params["mongoDB_Col_Refineries"]]
-        print("Connecting to Nominatim ...")
-        self.geolocator = Nominatim(user_agent = self.data_prep_params["nominatim_user_agent"])
+        # Single client (one connection pool) shared by all collections and stages
+        self.mongo_client = get_mongo_client(self.dbs_params)
+        mydb = self.mongo_client[self.dbs_params["mongoDB_Db"]]
+        self.mycol_tweets = mydb[self.dbs_params["mongoDB_Col_Tweets"]]
+        self.mycol_headlines = mydb[self.dbs_params["mongoDB_Col_Headlines"]]
+        self.mycol_merged = mydb[self.dbs_params["mongoDB_Col_Merged"]]
+        self.mycol_gpes = mydb[self.dbs_params["mongoDB_Col_GPEs"]]
+        self.mycol_refineries = mydb[self.dbs_params["mongoDB_Col_Refineries"]]
+        self.mycol_nlp_cache = mydb[self.dbs_params["mongoDB_Col_NLPCache"]]
+        self.mycol_reverse_geocode = mydb[self.dbs_params["mongoDB_Col_ReverseGeocode"]]
+        # Nominatim geolocator created on first use (only needed by some stages)
+        self._geolocator = None
+        # Cache of GPEs polygons created on first use, shared by Tweets and headlines matching
+        self._gpe_cache = None
+        # Refineries points loaded on first use, shared by Tweets and headlines matching
+        self._point_index = None
+        # Refineries loaded on first use, shared by matching and clustering
+        self._refinery_registry = None
         
         
     # Get params from json file
@@ -54,16 +62,71 @@ class iLox():
         self.clustering_params = self.all_params["clustering"]
         
     
+    # Get Nominatim geolocator, created on first call and shared by all stages
+    def get_geolocator(self):
+        if self._geolocator is None:
+            from geopy.geocoders import Nominatim
+            print("Connecting to Nominatim ...")
+            self._geolocator = Nominatim(user_agent = self.data_prep_params["nominatim_user_agent"])
+        return self._geolocator
+    
+    # Params of cache of GPEs polygons
+    def _gpe_cache_params(self):
+        return {"max_size": self.ref_match_params["global"]["gpe_cache_size"], 
+                "negative_ttl_days": self.ref_match_params["global"]["nominatim_negative_ttl_days"], 
+                "nominatim_max_attempts": self.ref_match_params["global"]["nominatim_max_attempts"], 
+                "nominatim_wait_error": self.ref_match_params["global"]["nominatim_wait_error"], 
+                "nominatim_rate_per_sec": self.ref_match_params["global"]["nominatim_rate_per_sec"], 
+                "nominatim_burst": self.ref_match_params["global"]["nominatim_burst"], 
+                "nominatim_max_workers": self.ref_match_params["global"]["nominatim_max_workers"]}
+    
+    # Get cache of GPEs polygons, created on first call and shared by all stages
+    def get_gpe_cache(self):
+        if self._gpe_cache is None:
+            self._gpe_cache = GPECache(
+                self.mycol_gpes, self.get_geolocator(), **self._gpe_cache_params())
+        return self._gpe_cache
+    
+    # Get cache of refineries reverse geocoding, created on each call (only used by DataPrep)
+    def get_reverse_geocode_cache(self):
+        return ReverseGeocodeCache(
+            self.mycol_reverse_geocode, self.get_geolocator(), 
+            self.data_prep_params["reverse_geocode_precision"], 
+            self.data_prep_params["reverse_geocode_max_attempts"], 
+            self.data_prep_params["reverse_geocode_wait_error"], 
+            self.data_prep_params["reverse_geocode_rate_per_sec"], 
+            self.data_prep_params["reverse_geocode_burst"], 
+            self.data_prep_params["reverse_geocode_max_workers"])
+    
+    # Get index of refineries points, created on first call and shared by all stages
+    def get_point_index(self):
+        if self._point_index is None:
+            self._point_index = RefineryPointIndex(self.mycol_refineries)
+        return self._point_index
+    
+    # Get registry of refineries, created on first call and shared by all stages
+    def get_refinery_registry(self):
+        if self._refinery_registry is None:
+            self._refinery_registry = RefineryRegistry(
+                self.data_prep_params["refineries_file"], self.mycol_refineries)
+        return self._refinery_registry
+    
+    # Params for matching worker processes to create their own connections, refineries and cache
+    def get_match_worker_params(self):
+        return {"dbs_params": self.dbs_params, 
+                "refineries_file": self.data_prep_params["refineries_file"], 
+                "nominatim_user_agent": self.data_prep_params["nominatim_user_agent"], 
+                "gpe_cache_params": self._gpe_cache_params()}
+        
+    
     # Store all Tweets/Headlines matched to at least 1 refinery in same database
+    # Only items matched since last merge (events stage completed) are upserted
     def merge_tweets_headlines(self):
         print("Merging Tweets and Headlines ...")
-        # Get all Tweets
-        all_tweets = list(self.mycol_tweets.find(
-            {"ref_match": {"$not": {"$size": 0}}, "events_tags": {"$not": {"$size": 0}}}, 
-            {"created_at": 1, "id_str": 1, "full_text": 1, "entities": 1, "user_id_str": 1, 
-             "retweet_count": 1, "favorite_count": 1, "reply_count": 1, "quote_count": 1, 
-             "favorited": 1, "retweeted": 1, "geo_tags": 1, "owner_tags": 1, "ref_match": 1, 
-             "events_tags": 1, "country_match": 1, "_id": 0}))
+        start = time.perf_counter()
+        write_batch_size = self.ref_match_params["global"]["write_batch_size"]
+        read_batch_size = self.ref_match_params["global"]["read_batch_size"]
+        prep_merged_col(self.mycol_merged, write_batch_size, read_batch_size)
         # Change keys for consistency with headlines
         convert_keys_tweets = {"created_at": "created_at", "id_str": "id", "full_text": "text", 
                                "entities": "entities", "user_id_str": "source_id", 
@@ -72,43 +135,31 @@ class iLox():
                                "favorited": "favorited", "retweeted": "retweeted", 
                                "geo_tags": "geo_tags", "owner_tags": "owner_tags", 
                                "ref_match": "ref_match", "events_tags": "events_tags", 
-                               "country_match": "country_match", "_id": "_id"}
-        all_tweets = [{convert_keys_tweets[k]: tweet[k] for k in tweet.keys()} 
-                      for tweet in all_tweets]
-        # Get all headlines
-        all_headlines = list(self.mycol_headlines.find(
-            {"ref_match": {"$not": {"$size": 0}}, "events_tags": {"$not": {"$size": 0}}}, 
-            {"firstCreated": 1, "storyId": 1, "text": 1, "snippet": 1, "sourceName": 1, 
-             "geo_tags": 1, "owner_tags": 1, "ref_match": 1, "events_tags": 1, "country_match": 1, 
-             "cluster_id": 1, "_id": 0}))
+                               "country_match": "country_match"}
         # Change keys for consistency with Tweets
         convert_keys_headlines = {"firstCreated": "created_at", "storyId": "id", "text": "text", 
                                   "snippet": "snippet", "sourceName": "source_id", 
                                   "geo_tags": "geo_tags", "owner_tags": "owner_tags", 
                                   "ref_match": "ref_match", "events_tags": "events_tags", 
-                                  "country_match": "country_match", "cluster_id": "cluster_id", 
-                                  "_id": "_id"}
-        all_headlines = [{convert_keys_headlines[k]: headline[k] for k in headline.keys()} 
-                         for headline in all_headlines]
-        # Create dataframe to set missing keys to NaN
-        all_items = pd.DataFrame(all_tweets + all_headlines)
-        # Change columns order
-        all_items = all_items[["id", "created_at", "text", "snippet", "source_id", "retweet_count", 
-                               "favorite_count", "reply_count", "quote_count", "favorited", 
-                               "retweeted", "entities", "geo_tags", "owner_tags", "ref_match", 
-                               "events_tags", "country_match", "cluster_id"]]
-        # Drop duplicates
-        all_items = all_items.drop_duplicates(subset = ["created_at", "text", "snippet"])
-        # Convert back to dictionary
-        all_items = all_items.to_dict(orient = "records")
-        # Create indexes if not already exist
-        existing_idx = self.mycol_merged.index_information()
-        if "id" not in existing_idx.keys():
-            self.mycol_merged.create_index(
-                [("id", pymongo.ASCENDING)], name = "id", unique = True)
-        # Insert in collection
-        status = bulk_write(self.mycol_merged, all_items)
-        del status
+                                  "country_match": "country_match", "cluster_id": "cluster_id"}
+        for mycol, convert_keys, date_key in [
+                (self.mycol_tweets, convert_keys_tweets, "created_at"), 
+                (self.mycol_headlines, convert_keys_headlines, "firstCreated")]:
+            existing_idx = mycol.index_information()
+            if "match_stage" not in existing_idx.keys():
+                mycol.create_index(
+                    [("match_stage", pymongo.ASCENDING)], name = "match_stage", unique = False)
+            prep_derived_fields(mycol, date_key)
+            prep_dates(mycol, date_key)
+            query = {"match_stage": STAGE_EVENTS, "n_ref_match": {"$gt": 0}, "has_events": True}
+            if self.ref_match_params["global"]["check_query_plans"]:
+                check_query_plan(
+                    mycol, query, self.ref_match_params["global"]["strict_query_plans"])
+            writer = merge_items(
+                mycol, self.mycol_merged, query, convert_keys, write_batch_size, read_batch_size)
+            complete_stage(mycol, {"match_stage": STAGE_EVENTS}, STAGE_MERGED)
+            print("%s: %s" % (mycol.name, writer.stats()))
+        print("Merge completed in %.2f s" % (time.perf_counter() - start))
         
         
     # Run
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Jul 25 11:02:37 2021
+
+@author: brend
+"""
+
+import queue
+import threading
+import pymongo
+from pymongo import InsertOne, UpdateOne
+
+
+# Counts of one write
+def _new_counts():
+    return {"inserted": 0, "upserted": 0, "modified": 0, "duplicates": 0, "failed": 0}
+
+
+class BulkWriter():
+
+    def __init__(self, mycol, batch_size = 1000, upsert_key = None, background = False,
+                 max_pending_batches = 2):
+
+        """
+        Write documents in unordered batches, duplicate key errors are counted and skipped,
+        other write errors are counted as failed
+        Args:
+            * mycol (pymongo.Collection): MongoDb collection to write to
+            * batch_size (int): Number of operations per bulk_write
+            * upsert_key (str): If set, documents are upserted ($set) on this field instead
+              of inserted
+            * background (bool): Write batches from a background thread, callers only wait
+              when max_pending_batches batches are not written yet
+            * max_pending_batches (int): Batches waiting for background thread
+        """
+
+        self.mycol = mycol
+        self.batch_size = batch_size
+        self.upsert_key = upsert_key
+        self.background = background
+        self.requests = []
+        # Counts of each write, and total
+        self.flushes = []
+        self.counts = _new_counts()
+        self._lock = threading.Lock()
+        self._error = None
+        self._thread = None
+        if self.background:
+            self._queue = queue.Queue(maxsize = max_pending_batches)
+            self._thread = threading.Thread(target = self._write_loop, daemon = True)
+            self._thread.start()
+
+    # Add document (inserted, or upserted on upsert_key)
+    def insert(self, doc):
+        if self.upsert_key is None:
+            self.write(InsertOne(doc))
+        else:
+            self.write(UpdateOne({self.upsert_key: doc[self.upsert_key]}, {"$set": doc},
+                                 upsert = True))
+
+    def insert_many(self, docs):
+        for doc in docs:
+            self.insert(doc)
+
+    # Add any write operation (InsertOne, UpdateOne, DeleteMany ...)
+    def write(self, request):
+        self.requests.append(request)
+        if len(self.requests) >= self.batch_size:
+            self.flush()
+
+    # Write pending operations (handed to background thread if background)
+    def flush(self):
+        self._raise_error()
+        if len(self.requests) == 0:
+            return
+        requests = self.requests
+        self.requests = []
+        if self.background:
+            self._queue.put(requests)
+        else:
+            self._write(requests)
+
+    # Write pending operations and wait until all written, stop background thread
+    def close(self):
+        self.flush()
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self._raise_error()
+
+    def _write_loop(self):
+        while True:
+            requests = self._queue.get()
+            if requests is None:
+                return
+            try:
+                self._write(requests)
+            except Exception as e:
+                # Raised in caller thread on next flush or close
+                self._error = e
+
+    def _raise_error(self):
+        if self._error is not None:
+            error = self._error
+            self._error = None
+            raise error
+
+    def _write(self, requests):
+        counts = _new_counts()
+        try:
+            result = self.mycol.bulk_write(requests, ordered = False)
+            counts["inserted"] = result.inserted_count
+            counts["upserted"] = result.upserted_count
+            counts["modified"] = result.modified_count
+        except pymongo.errors.BulkWriteError as e:
+            counts["inserted"] = e.details.get("nInserted", 0)
+            counts["upserted"] = e.details.get("nUpserted", 0)
+            counts["modified"] = e.details.get("nModified", 0)
+            counts["duplicates"] = len([i for i in e.details["writeErrors"] if i["code"] == 11000])
+            counts["failed"] = len(e.details["writeErrors"]) - counts["duplicates"]
+        with self._lock:
+            self.flushes.append(counts)
+            for k, v in counts.items():
+                self.counts[k] += v
+        return counts
+
+    def stats(self):
+        return "%s writes: %r inserted, %r upserted, %r modified, %r duplicates, %r failed" % (
+            self.mycol.name, self.counts["inserted"], self.counts["upserted"],
+            self.counts["modified"], self.counts["duplicates"], self.counts["failed"])
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Jul 15 22:31:07 2021
+
+@author: brend
+"""
+
+from itertools import islice
+
+
+# Split iterable (list, cursor, generator) in lists of size items
+def iter_chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if len(chunk) == 0:
+            return
+        yield chunk
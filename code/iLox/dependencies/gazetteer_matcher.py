@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Jul 10 18:12:40 2021
+
+@author: brend
+"""
+
+import os
+import re
+import gc
+import json
+import shutil
+import unicodedata
+import numpy as np
+import pandas as pd
+from collections import deque
+from iLox.dependencies.match_state import inputs_fingerprint
+
+
+# Increase when format of compiled gazetteer or matching rules change, compiled gazetteers are
+# then rebuilt
+GAZETTEER_VERSION = 2
+
+# Types of names, stored as codes in compiled gazetteer
+GAZETTEER_TYPES = ["refname", "cityname", "ownername"]
+
+
+# Lowercase text and remove accents (same as MongoDb text index, diacritic insensitive)
+def fold_text(text):
+    text = unicodedata.normalize("NFKD", text.lower())
+    return "".join([c for c in text if not unicodedata.combining(c)])
+
+
+# Same definition of word character as regex \w
+def _is_word(c):
+    return c.isalnum() or c == "_"
+
+
+# Same definition of word boundary as regex \b
+def _is_boundary(text, pos):
+    before = pos > 0 and _is_word(text[pos - 1])
+    after = pos < len(text) and _is_word(text[pos])
+    return before != after
+
+
+# Keep only long name if short name overlap, e.g. Total and
+# Saudi Aramco Total Refining and Petrochemical Company
+# And also drop duplicates on id
+def clean_owner_tags(owner_tags):
+    unique_tags = []
+    seen = set()
+    for owner_tag in owner_tags:
+        if (owner_tag["id"], owner_tag["type"]) not in seen:
+            seen.add((owner_tag["id"], owner_tag["type"]))
+            unique_tags.append(owner_tag)
+    if len(set([i["initial"] for i in unique_tags])) > 1:
+        matchs = [str(i["match"]) for i in unique_tags]
+        overlaps = set([i for i in matchs if len(
+            [i2 for i2 in matchs if len(i2) > len(i) and i.lower() in i2.lower()]) > 0])
+        unique_tags = [i for i in unique_tags if str(i["match"]) not in overlaps]
+    return unique_tags
+
+
+# Regexes of name searched case sensitive (as is and upper case), whole word
+def _case_sensitive_regexes(initial):
+    return (re.compile("\\b" + re.escape(initial) + "\\b"),
+            re.compile("\\b" + re.escape(initial.upper()) + "\\b"))
+
+
+# Aho-Corasick automaton, finds all occurrences of all patterns in one pass over the text
+class _Automaton():
+
+    def __init__(self):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+
+    # Add pattern to trie, value is returned for each occurrence found
+    def add(self, pattern, value):
+        node = 0
+        for c in pattern:
+            next_node = self.goto[node].get(c)
+            if next_node is None:
+                next_node = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append([])
+                self.goto[node][c] = next_node
+            node = next_node
+        self.out[node].append((len(pattern), value))
+
+    # Compute failure links (breadth first), must be called once all patterns added
+    def build(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for c, next_node in self.goto[node].items():
+                queue.append(next_node)
+                fail = self.fail[node]
+                while fail and c not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_node] = self.goto[fail].get(c, 0)
+                self.out[next_node] = self.out[next_node] + self.out[self.fail[next_node]]
+
+    # Yield (start, end, value) for every pattern occurrence in text
+    def find_all(self, text):
+        goto, fail, out = self.goto, self.fail, self.out
+        node = 0
+        for end, c in enumerate(text, 1):
+            while node and c not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(c, 0)
+            for length, value in out[node]:
+                yield end - length, end, value
+
+    # Arrays of automaton (values must be (index, whole_word) tuples)
+    def to_arrays(self):
+        edges = [(node, ord(c), next_node) for node, transitions in enumerate(self.goto)
+                 for c, next_node in transitions.items()]
+        out = [(node, length, index, whole_word) for node, outputs in enumerate(self.out)
+               for length, (index, whole_word) in outputs]
+        return {"edges": np.array(edges, dtype = np.int32).reshape(-1, 3),
+                "fail": np.array(self.fail, dtype = np.int32),
+                "out": np.array(out, dtype = np.int32).reshape(-1, 4)}
+
+    # Restore automaton from arrays saved by to_arrays
+    def from_arrays(self, arrays):
+        self.fail = arrays["fail"].tolist()
+        self.goto = [{} for i in self.fail]
+        self.out = [[] for i in self.fail]
+        for node, c, next_node in arrays["edges"].tolist():
+            self.goto[node][chr(c)] = next_node
+        for node, length, index, whole_word in arrays["out"].tolist():
+            self.out[node].append((length, (index, bool(whole_word))))
+        return self
+
+
+class GazetteerMatcher():
+
+    def __init__(self, *gazetteers):
+
+        """
+        Match texts against refineries, cities and owners names in a single pass
+        Args:
+            * gazetteers (list): Lists of names (dicts with id, initial, match and type keys),
+              as generated by DataPrep
+        Rules (same as previous MongoDb $regex + $text queries):
+            * refname: whole word, case and accents insensitive
+            * cityname: whole word, case and accents insensitive
+            * ownername: whole word if less than 8 characters, otherwise anywhere in text,
+              case insensitive, also accents insensitive if more than 10 characters.
+              "Total" is searched case sensitive (as "TOTAL" in headlines snippets)
+        """
+
+        self.entries = [entry for gazetteer in gazetteers for entry in gazetteer]
+        # Patterns searched on lowercase text without accents
+        self._folded = _Automaton()
+        # Patterns searched on lowercase text
+        self._lowered = _Automaton()
+        # Patterns searched case sensitive, {initial: (regex, regex upper case, [indexes])}
+        self._case_sensitive = {}
+        for index, entry in enumerate(self.entries):
+            match = str(entry["match"])
+            if len(match) == 0:
+                continue
+            if entry["type"] == "ownername":
+                if len(match) < 8:
+                    if entry["initial"] == "Total":
+                        if entry["initial"] not in self._case_sensitive.keys():
+                            self._case_sensitive[entry["initial"]] = _case_sensitive_regexes(
+                                entry["initial"]) + ([],)
+                        self._case_sensitive[entry["initial"]][2].append(index)
+                    else:
+                        self._lowered.add(match.lower(), (index, True))
+                elif len(match) <= 10:
+                    self._lowered.add(match.lower(), (index, False))
+                else:
+                    self._folded.add(fold_text(match), (index, False))
+            # refname and cityname
+            else:
+                self._folded.add(fold_text(match), (index, True))
+        self._folded.build()
+        self._lowered.build()
+
+    # Return indexes of entries found in text
+    def match(self, text, case_sensitive_upper = False):
+        found = set()
+        if not isinstance(text, str) or len(text) == 0:
+            return found
+        for this_text, automaton in [(fold_text(text), self._folded),
+                                     (text.lower(), self._lowered)]:
+            for start, end, (index, whole_word) in automaton.find_all(this_text):
+                if index in found:
+                    continue
+                if not whole_word or (_is_boundary(this_text, start) and
+                                      _is_boundary(this_text, end)):
+                    found.add(index)
+        for regex, regex_upper, indexes in self._case_sensitive.values():
+            if (regex_upper if case_sensitive_upper else regex).search(text) is not None:
+                found.update(indexes)
+        return found
+
+    # Convert indexes of entries found to geo_tags and owner_tags (in gazetteers order)
+    def tags(self, found):
+        geo_tags = []
+        owner_tags = []
+        for index in sorted(found):
+            entry = dict(self.entries[index])
+            if entry["type"] == "ownername":
+                owner_tags.append(entry)
+            else:
+                geo_tags.append(entry)
+        return geo_tags, owner_tags
+
+
+# Save compiled gazetteer in directory: entries columns, automata arrays (.npy files loaded with
+# memory map) and names searched case sensitive
+def save_gazetteer(matcher, directory):
+    os.makedirs(directory, exist_ok = True)
+    arrays = {"ids": np.array([i["id"] for i in matcher.entries], dtype = np.int64),
+              "types": np.array([GAZETTEER_TYPES.index(i["type"]) for i in matcher.entries],
+                                dtype = np.int8)}
+    for name, automaton in [("folded", matcher._folded), ("lowered", matcher._lowered)]:
+        arrays.update({name + "_" + k: v for k, v in automaton.to_arrays().items()})
+    for name, array in arrays.items():
+        np.save(os.path.join(directory, name + ".npy"), array)
+    with open(os.path.join(directory, "names.json"), "w", encoding = "utf-8") as f:
+        json.dump({"initial": [i["initial"] for i in matcher.entries],
+                   "match": [i["match"] for i in matcher.entries],
+                   "case_sensitive": {k: v[2] for k, v in matcher._case_sensitive.items()}}, f)
+
+
+# Load compiled gazetteer saved by save_gazetteer
+def load_gazetteer(directory):
+    def load_array(name):
+        return np.load(os.path.join(directory, name + ".npy"), mmap_mode = "r")
+    with open(os.path.join(directory, "names.json"), encoding = "utf-8") as f:
+        names = json.load(f)
+    matcher = GazetteerMatcher()
+    matcher.entries = [{"id": i, "initial": initial, "match": match, "type": GAZETTEER_TYPES[t]}
+                       for i, initial, match, t in zip(load_array("ids").tolist(), names["initial"],
+                                                       names["match"], load_array("types").tolist())]
+    # Garbage collection paused while creating automata (many small objects, all kept)
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for name, automaton in [("folded", matcher._folded), ("lowered", matcher._lowered)]:
+            automaton.from_arrays({k: load_array(name + "_" + k) for k in
+                                   ["edges", "fail", "out"]})
+    finally:
+        if gc_enabled:
+            gc.enable()
+    matcher._case_sensitive = {k: _case_sensitive_regexes(k) + (v,)
+                               for k, v in names["case_sensitive"].items()}
+    return matcher
+
+
+# Get matcher of names files (refineries, cities and owners CSV files generated by DataPrep)
+# Compiled gazetteer loaded from gazetteer_dir if built from same files content, otherwise
+# rebuilt from files, saved and older compiled gazetteers removed
+def get_gazetteer_matcher(names_files, gazetteer_dir):
+    directory = os.path.join(gazetteer_dir, "gazetteer_v%r_%s" % (
+        GAZETTEER_VERSION, inputs_fingerprint(names_files, GAZETTEER_VERSION)))
+    if os.path.exists(os.path.join(directory, "names.json")):
+        return load_gazetteer(directory)
+    print("Compiling gazetteer ...")
+    matcher = GazetteerMatcher(*[pd.read_csv(i).to_dict(orient = "records") for i in names_files])
+    # Saved in temporary directory then renamed, a partly written gazetteer is never loaded
+    tmp_directory = directory + ".tmp%r" % os.getpid()
+    save_gazetteer(matcher, tmp_directory)
+    shutil.rmtree(directory, ignore_errors = True)
+    os.replace(tmp_directory, directory)
+    for other in os.listdir(gazetteer_dir):
+        if other.startswith("gazetteer_v") and other != os.path.basename(directory):
+            shutil.rmtree(os.path.join(gazetteer_dir, other), ignore_errors = True)
+    return matcher
@@ -5,118 +5,57 @@ Created on Sat Jun  5 00:43:02 2021
 @author: brend
 """
 
-import time
 from tqdm import tqdm
-from datetime import datetime
-from geopy.exc import GeocoderUnavailable, GeocoderServiceError
-import pymongo
+from multiprocessing import Pool
+import numpy as np
 import pandas as pd
-from area import area
-import warnings
+from iLox.dependencies.write_buffer import WriteBuffer
+from iLox.dependencies.mongo_client import get_mongo_client
+from iLox.dependencies.chunks import iter_chunks
+from iLox.dependencies.refinery_registry import RefineryRegistry
+from iLox.dependencies.point_index import RefineryPointIndex
+from iLox.dependencies.gpe_cache import GPECache
+from iLox.dependencies.match_state import with_derived_fields
+from iLox.dependencies.query_plan import check_query_plan
 
 
+# Canonical signature of item's tags (refnames, citynames, owners, GPEs), items with same
+# signature and date in same validity epoch of refineries have same ref_match
+def tags_signature(item):
+    return (tuple(sorted(set([int(i["id"]) for i in item["geo_tags"] if i["type"] == "refname"]))), 
+            tuple(sorted(set([int(i["id"]) for i in item["geo_tags"] if i["type"] == "cityname"]))), 
+            tuple(sorted(set([(int(i["id"]), i["type"]) for i in item["owner_tags"]]))), 
+            tuple(sorted([i["match"] for i in item["geo_tags"] if i["type"] == "GPE"])))
 
-# Get probabilities of match for refineries
-def get_match_proba(refineries_df, mycol_items, mycol_refineries, mycol_gpes, geolocator, 
-                    display_pb, match_start, date_key, nominatim_max_attempts = 10, 
-                    nominatim_wait_error = 5, nominatim_wait = 0.5):
-    
-    # Query location on Nominatim
-    def query_nominatim(geolocator, gpe, max_attempts = nominatim_max_attempts, 
-                        wait_error = nominatim_wait_error, wait = nominatim_wait, 
-                        exactly_one = True):
-        # Try max_attempts times
-        for i in range(max_attempts):
-            try:
-                geo_data = geolocator.geocode(
-                    gpe, geometry = "geojson", language = "en", exactly_one = exactly_one)
-                # Wait normal wait time per request
-                time.sleep(wait)
-                # If successful then return output
-                return geo_data
-            # Otherwise wait wait_error seconds
-            except GeocoderUnavailable:
-                time.sleep(wait_error)
-            # Sometimes exactly_one = False creates GeocoderServiceError, retry with True
-            except GeocoderServiceError:
-                time.sleep(wait)
-                try:
-                    geo_data = geolocator.geocode(
-                        gpe, geometry = "geojson", language = "en", exactly_one = True)
-                    # Wait normal wait time per request
-                    time.sleep(wait)
-                    # If successful then return output
-                    return [geo_data]
-                # Otherwise wait wait_error seconds
-                except (GeocoderUnavailable, GeocoderServiceError) as e:
-                    time.sleep(wait_error)
-        # If exit loop after trying max_attempts times then try request for Paris
-        try:
-            geo_data = geolocator.geocode(
-                "Paris", geometry = "geojson", language = "en")
-            # If request is successful return None, will continue with next gpe
-            return None
-        # Otherwise raise error, means Nominatim API is down, break execution
-        except GeocoderUnavailable:
-            raise
+
+class RefineryMatcher():
     
-    # Get polygons for GPEs
-    def get_polygons(mycol_gpes, geolocator, gpes):
-        polygons = []
-        for gpe in gpes:
-            # If GPE already exists in GPEs database then load from there and save on Nominatim queries
-            if mycol_gpes.count_documents({"GPEs": gpe}) > 0:
-                polygons.extend([i["boundaries"] for i in list(mycol_gpes.find(
-                    {"GPEs": gpe}, {"boundaries": 1, "_id": 0}).sort([("importance", -1)]))])
-            # Otherwise query from Nominatim then save in GPEs database
-            else:
-                try:
-                    geo_data = query_nominatim(geolocator, gpe, exactly_one = False)
-                except GeocoderUnavailable:
-                    warnings.warn("Nominatim API is down")
-                    break
-                if geo_data is not None:
-                    geo_data = [i for i in geo_data if "geojson" in i.raw.keys() and 
-                                i.raw["geojson"]["type"] not in ["Point", "LineString", "MultiLineString"]]
-                    for this_geo_data in geo_data:
-                        this_geo_data.raw["GPEs"] = list(set(
-                            [gpe, this_geo_data.raw["display_name"].split(",")[0].strip()]))
-                        # If this location (from boundaries) already in database, add GPE to GPEs of that location
-                        if mycol_gpes.count_documents(
-                                {"boundaries": this_geo_data.raw["geojson"]}) > 0:
-                            mycol_gpes.update_one(
-                                {"boundaries": this_geo_data.raw["geojson"]}, {"$push": {"GPEs": gpe}})
-                            polygons.append(this_geo_data.raw["geojson"])
-                        # Else format to save in database
-                        else:
-                            keep_keys = ["class", "display_name", "geojson", "importance", "lat", "lon", 
-                                         "osm_id", "osm_type", "place_id", "type", "GPEs"]
-                            this_geo_data = {k: this_geo_data.raw[k] for k in keep_keys if 
-                                             k in this_geo_data.raw.keys()}
-                            this_geo_data["point"] = {
-                                "type": "Point", "coordinates": [float(this_geo_data.pop("lon")), 
-                                                                 float(this_geo_data.pop("lat"))]}
-                            this_geo_data["boundaries"] = this_geo_data.pop("geojson")
-                            # Insert in MongoDb
-                            try:
-                                mycol_gpes.insert_one(this_geo_data)
-                            except pymongo.errors.DuplicateKeyError:
-                                pass
-                            polygons.append(this_geo_data["boundaries"])
-                else:
-                    # If no result then continue
-                    continue
-        return polygons
+    def __init__(self, registry, point_index, gpe_cache):
+        
+        """
+        Match items to refineries from their geo_tags and owner_tags, items with same signature
+        are matched once and get same ref_match
+        Args:
+            * registry (RefineryRegistry): Refineries and their validity intervals
+            * point_index (RefineryPointIndex): Refineries points, to find refineries within GPEs
+            * gpe_cache (GPECache): Polygons of GPEs
+        """
+        
+        self.registry = registry
+        self.point_index = point_index
+        self.gpe_cache = gpe_cache
+        # ref_match (None if no match) of each signature
+        self.decisions = {}
+        self.n_items = 0
+        self.n_vectorized = 0
     
     # Use GPEs to match refineries, potentially with cityname, refname or ownername
-    def match_gpes(mycol_gpes, mycol_refineries, refineries_df, geolocator, headline_date, 
-                   gpes, geo_tags, owner_tags):
-        global polygons
-        # Get polygons
-        polygons = get_polygons(mycol_gpes, geolocator, gpes["match"].tolist())
-        # Compute area in sqm to start with largest
+    def _match_gpes(self, headline_date, gpes, geo_tags, owner_tags):
+        # Get polygons (with area in sqm) from cache
+        polygons = [i for gpe in gpes["match"].tolist() for i in self.gpe_cache.get(gpe)]
+        # Start with largest area
         areas = pd.DataFrame(
-            {"area": {index: area(polygons[index]) for index in range(len(polygons))}}
+            {"area": {index: polygons[index]["area"] for index in range(len(polygons))}}
             ).sort_values("area", ascending = False)
         polygons = {index: polygons[index] for index in range(len(polygons))}
         all_matchs = []
@@ -125,13 +64,9 @@ def get_match_proba(refineries_df, mycol_items, mycol_refineries, mycol_gpes, ge
         if len(geo_tags[geo_tags["type"] == "refname"]) == 0 and len(owner_tags) == 0:
             # Loop through polygons starting from largest
             for polygon_index in areas.index:
-                ref_ids = [i["GeoAssetID"] for i in mycol_refineries.find(
-                    {"point": {"$geoWithin": {"$geometry": polygons[polygon_index]}}}, 
-                    {"GeoAssetID": 1, "point": 1, "_id": 0})]
-                refineries_match = refineries_df[
-                    refineries_df["GeoAssetID"].isin(ref_ids) & 
-                    (refineries_df["FromDate"] <= headline_date) & 
-                    (refineries_df["ToDate"] >= headline_date)]
+                ref_ids = self.point_index.within(polygons[polygon_index]["id"], 
+                                             polygons[polygon_index]["boundaries"])
+                refineries_match = self.registry.active(ref_ids, headline_date)
                 # If perfect match then stop
                 if len(refineries_match) == 1:
                     return refineries_match
@@ -140,20 +75,14 @@ def get_match_proba(refineries_df, mycol_items, mycol_refineries, mycol_gpes, ge
         # If refnames then first priority
         if len(geo_tags[geo_tags["type"] == "refname"]) > 0:
             ref_ids_initial = geo_tags[geo_tags["type"] == "refname"]["id"].astype(int).tolist()
-            refineries_match = refineries_df[
-                refineries_df["GeoAssetID"].isin(ref_ids_initial) & 
-                (refineries_df["FromDate"] <= headline_date) & 
-                (refineries_df["ToDate"] >= headline_date)]
-            ref_ids_initial = refineries_match["GeoAssetID"].tolist()
+            refineries_match = self.registry.active(ref_ids_initial, headline_date)
+            ref_ids_initial = self.registry.get_ids(refineries_match)
             # Loop through polygons starting from largest
             for polygon_index in areas.index:
-                ref_ids = [i["GeoAssetID"] for i in mycol_refineries.find(
-                    {"point": {"$geoWithin": {"$geometry": polygons[polygon_index]}}, 
-                     "GeoAssetID": {"$in": ref_ids_initial}}, {"GeoAssetID": 1, "point": 1, "_id": 0})]
-                refineries_match = refineries_df[
-                    refineries_df["GeoAssetID"].isin(ref_ids) & 
-                    (refineries_df["FromDate"] <= headline_date) & 
-                    (refineries_df["ToDate"] >= headline_date)]
+                ref_ids = [i for i in self.point_index.within(polygons[polygon_index]["id"], 
+                                                         polygons[polygon_index]["boundaries"]) 
+                           if i in ref_ids_initial]
+                refineries_match = self.registry.active(ref_ids, headline_date)
                 # If perfect match then stop
                 if len(refineries_match) == 1:
                     return refineries_match
@@ -162,21 +91,14 @@ def get_match_proba(refineries_df, mycol_items, mycol_refineries, mycol_gpes, ge
         # If ownernames then second priority
         if len(owner_tags) > 0:
             ref_ids_initial = owner_tags["id"].astype(int).tolist()
-            refineries_match = refineries_df[
-                refineries_df["GeoAssetID"].isin(ref_ids_initial) & 
-                (refineries_df["FromDate"] <= headline_date) & 
-                (refineries_df["ToDate"] >= headline_date)]
-            ref_ids_initial = refineries_match["GeoAssetID"].tolist()
+            refineries_match = self.registry.active(ref_ids_initial, headline_date)
+            ref_ids_initial = self.registry.get_ids(refineries_match)
             # Loop through polygons starting from largest
             for polygon_index in areas.index:
-                ref_ids = [i["GeoAssetID"] for i in mycol_refineries.find(
-                    {"point": {"$geoWithin": {"$geometry": polygons[polygon_index]}}, 
-                     "GeoAssetID": {"$in": ref_ids_initial}}, 
-                    {"GeoAssetID": 1, "point": 1, "_id": 0})]
-                refineries_match = refineries_df[
-                    refineries_df["GeoAssetID"].isin(ref_ids) & 
-                    (refineries_df["FromDate"] <= headline_date) & 
-                    (refineries_df["ToDate"] >= headline_date)]
+                ref_ids = [i for i in self.point_index.within(polygons[polygon_index]["id"], 
+                                                         polygons[polygon_index]["boundaries"]) 
+                           if i in ref_ids_initial]
+                refineries_match = self.registry.active(ref_ids, headline_date)
                 # If perfect match then stop
                 if len(refineries_match) == 1:
                     return refineries_match
@@ -188,21 +110,14 @@ def get_match_proba(refineries_df, mycol_items, mycol_refineries, mycol_gpes, ge
                 geo_tags["type"] == "refname"]["id"].astype(int).tolist()
             ref_ids_initial_ownames = owner_tags["id"].astype(int).tolist()
             ref_ids_initial = set(ref_ids_initial_ownames).intersection(ref_ids_initial_refnames)
-            refineries_match = refineries_df[
-                refineries_df["GeoAssetID"].isin(ref_ids_initial) & 
-                (refineries_df["FromDate"] <= headline_date) & 
-                (refineries_df["ToDate"] >= headline_date)]
-            ref_ids_initial = refineries_match["GeoAssetID"].tolist()
+            refineries_match = self.registry.active(ref_ids_initial, headline_date)
+            ref_ids_initial = self.registry.get_ids(refineries_match)
             # Loop through polygons starting from largest
             for polygon_index in areas.index:
-                ref_ids = [i["GeoAssetID"] for i in mycol_refineries.find(
-                    {"point": {"$geoWithin": {"$geometry": polygons[polygon_index]}}, 
-                     "GeoAssetID": {"$in": ref_ids_initial}}, 
-                    {"GeoAssetID": 1, "point": 1, "_id": 0})]
-                refineries_match = refineries_df[
-                    refineries_df["GeoAssetID"].isin(ref_ids) & 
-                    (refineries_df["FromDate"] <= headline_date) & 
-                    (refineries_df["ToDate"] >= headline_date)]
+                ref_ids = [i for i in self.point_index.within(polygons[polygon_index]["id"], 
+                                                         polygons[polygon_index]["boundaries"]) 
+                           if i in ref_ids_initial]
+                refineries_match = self.registry.active(ref_ids, headline_date)
                 # If perfect match then stop
                 if len(refineries_match) == 1:
                     return refineries_match
@@ -215,16 +130,8 @@ def get_match_proba(refineries_df, mycol_items, mycol_refineries, mycol_gpes, ge
             best_match = best_match[0]
         return best_match
     
-    # Get all items with at least 1 geo_tag, unmatched yet and according to timeframe
-    match_items = [i for i in mycol_items.find(
-        {date_key: {"$gte": match_start}, "geo_tags": {"$not": {"$size": 0}}, 
-         "ref_match": {"$size": 0}}, {"geo_tags": 1, "owner_tags": 1, date_key: 1})]
-   
-    # Loop through each item
-    for item in tqdm(match_items, disable = display_pb, 
-                     desc = "Matching to refineries", leave = True):
-        item_date = datetime.strptime(item[date_key], 
-                                      "%Y-%m-%dT%H:%M:%S.%fZ")
+    # Match item with geo_tags, return ref_match (None if no match)
+    def _match_item(self, item, item_date):
         geo_tags = pd.DataFrame(item["geo_tags"])
         gpes = geo_tags[geo_tags["type"].isin(["GPE"])]
         geo_tags = geo_tags[
@@ -239,18 +146,10 @@ def get_match_proba(refineries_df, mycol_items, mycol_refineries, mycol_gpes, ge
         # First look at refineries names refname
         ref_ids = refnames["id"].astype(int).tolist()
         # Get list of refineries with selected ids and active at the time of the item
-        refineries_match = refineries_df[
-            refineries_df["GeoAssetID"].isin(ref_ids) & 
-            (refineries_df["FromDate"] <= item_date) & 
-            (refineries_df["ToDate"] >= item_date)]
-        # If only 1 match then save to collection with proba = 100% and continue
+        refineries_match = self.registry.active(ref_ids, item_date)
+        # If only 1 match then match with proba = 100%
         if len(refineries_match) == 1:
-            match_dict = refineries_match[["GeoAssetID", "GeoAssetName"]].copy()
-            match_dict["confidence"] = 1.0
-            mycol_items.update_one(
-                {"_id": item["_id"]}, 
-                {"$set": {"ref_match": match_dict.to_dict(orient = "records")}})
-            continue
+            return self.registry.ref_match(refineries_match, 1.0)
         elif len(refineries_match) > 1:
             all_matchs.append(refineries_match)
         # Otherwise look at city - keep only ids that appear twice (must match for refname + city)
@@ -258,26 +157,14 @@ def get_match_proba(refineries_df, mycol_items, mycol_refineries, mycol_gpes, ge
         ref_ids = list(set([r for r in ref_ids if 
                             ref_ids.count(r) == len(geo_tags["type"].unique())]))
         # Get list of refineries with selected ids and active at the time of the item
-        refineries_match = refineries_df[
-            refineries_df["GeoAssetID"].isin(ref_ids) & 
-            (refineries_df["FromDate"] <= item_date) & 
-            (refineries_df["ToDate"] >= item_date)]
-        # If only 1 match then save to collection with proba = 100% and continue
+        refineries_match = self.registry.active(ref_ids, item_date)
+        # If only 1 match then match with proba = 100%
         if len(refineries_match) == 1:
-            match_dict = refineries_match[["GeoAssetID", "GeoAssetName"]].copy()
-            match_dict["confidence"] = 1.0
-            mycol_items.update_one(
-                {"_id": item["_id"]}, 
-                {"$set": {"ref_match": match_dict.to_dict(orient = "records")}})
-            continue
-        # Else if > 1 match and no owner information or GPE then save all matchs in collection with proba = 1/n matchs
+            return self.registry.ref_match(refineries_match, 1.0)
+        # Else if > 1 match and no owner information or GPE then match all with proba = 1/n matchs
         elif len(refineries_match) > 1 and len(owner_tags) == 0 and len(gpes) == 0:
-            match_dict = refineries_match[["GeoAssetID", "GeoAssetName"]].copy()
-            match_dict["confidence"] = round(1.0 / len(match_dict), 2)
-            mycol_items.update_one(
-                {"_id": item["_id"]}, 
-                {"$set": {"ref_match": match_dict.to_dict(orient = "records")}})
-            continue
+            return self.registry.ref_match(
+                refineries_match, round(1.0 / len(refineries_match), 2))
         # Else if > 1 match and owner information or GPE then add matchs found to all_matchs list
         elif len(refineries_match) > 1:
             all_matchs.append(refineries_match)
@@ -292,80 +179,267 @@ def get_match_proba(refineries_df, mycol_items, mycol_refineries, mycol_gpes, ge
                 ref_ids = owner_tags[
                     owner_tags["type"] == "ownername"]["id"].astype(int).tolist()
             # Get list of refineries with selected ids and active at the time of the item
-            refineries_match = refineries_df[
-                refineries_df["GeoAssetID"].isin(ref_ids) & 
-                (refineries_df["FromDate"] <= item_date) & 
-                (refineries_df["ToDate"] >= item_date)]
-            # If only 1 match then save to collection with proba = 100% and continue
+            refineries_match = self.registry.active(ref_ids, item_date)
+            # If only 1 match then match with proba = 100%
             if len(refineries_match) == 1:
-                match_dict = refineries_match[["GeoAssetID", "GeoAssetName"]].copy()
-                match_dict["confidence"] = 1.0
-                mycol_items.update_one(
-                    {"_id": item["_id"]}, 
-                    {"$set": {"ref_match": match_dict.to_dict(orient = "records")}})
-                continue
+                return self.registry.ref_match(refineries_match, 1.0)
             # Else if > 1 match then add matchs found to all_matchs list
             elif len(refineries_match) > 1:
                 all_matchs.append(refineries_match)
         # Else if GPE information then use it
         if len(gpes) > 0:
-            refineries_match = match_gpes(mycol_gpes, mycol_refineries, refineries_df, 
-                                          geolocator, item_date, gpes, geo_tags, owner_tags)
-            # If only 1 match then save to collection with proba = 100% and continue
+            refineries_match = self._match_gpes(item_date, gpes, geo_tags, owner_tags)
+            # If only 1 match then match with proba = 100%
             if len(refineries_match) == 1:
-                match_dict = refineries_match[["GeoAssetID", "GeoAssetName"]].copy()
-                match_dict["confidence"] = 1.0
-                mycol_items.update_one(
-                    {"_id": item["_id"]}, 
-                    {"$set": {"ref_match": match_dict.to_dict(orient = "records")}})
-                continue
+                return self.registry.ref_match(refineries_match, 1.0)
             # Else if > 1 match then add matchs found to all_matchs list
             elif len(refineries_match) > 1:
                 all_matchs.append(refineries_match)
-        # If found some match then add best (lowest number of refineries) in collection with proba = 1/n matchs
+        # If found some match then match best (lowest number of refineries) with proba = 1/n matchs
         if len(all_matchs) > 0:
             best_match = [i for i in all_matchs if len(i) == 
                           min([len(i2) for i2 in all_matchs])][0]
-            match_dict = best_match[["GeoAssetID", "GeoAssetName"]].copy()
-            match_dict["confidence"] = round(1.0 / len(match_dict), 2)
-            mycol_items.update_one(
-                {"_id": item["_id"]}, 
-                {"$set": {"ref_match": match_dict.to_dict(orient = "records")}})
-            continue
-        # Otherwise continue
-        else:
-            continue
+            return self.registry.ref_match(
+                best_match, round(1.0 / len(best_match), 2))
+        # Otherwise no match
+        return None
         
-    # Get all items with owner_tag but no geo_tag
-    match_items = [i for i in mycol_items.find(
-        {date_key: {"$gte": match_start}, 
-         "geo_tags": {"$size": 0}, "owner_tags": {"$not": {"$size": 0}}}, 
-        {"geo_tags": 1, "owner_tags": 1, date_key: 1})]
-    # Loop through each item
-    for item in tqdm(match_items, disable = display_pb, 
-                     desc = "Matching to refineries (only owner_tags)", leave = True):
-        item_date = datetime.strptime(item[date_key], "%Y-%m-%dT%H:%M:%S.%fZ")
-        owner_tags = pd.DataFrame(
-            item["owner_tags"]).drop_duplicates(subset = ["id", "type"])
-        ref_ids = owner_tags[owner_tags["type"] == "ownername"]["id"].astype(int).tolist()
-        # Get list of refineries with selected ids and active at the time of the item
-        refineries_match = refineries_df[
-            refineries_df["GeoAssetID"].isin(ref_ids) & 
-            (refineries_df["FromDate"] <= item_date) & 
-            (refineries_df["ToDate"] >= item_date)]
-        # If only 1 match then save to collection with proba = 100% and continue
-        if len(refineries_match) == 1:
-            match_dict = refineries_match[["GeoAssetID", "GeoAssetName"]].copy()
-            match_dict["confidence"] = 1.0
-            mycol_items.update_one(
-                {"_id": item["_id"]}, 
-                {"$set": {"ref_match": match_dict.to_dict(orient = "records")}})
-            continue
-        # Otherwise save all matchs in collection with proba = 1/n matchs
-        elif len(refineries_match) > 1:
-            match_dict = refineries_match[["GeoAssetID", "GeoAssetName"]].copy()
-            match_dict["confidence"] = round(1.0 / len(match_dict), 2)
-            mycol_items.update_one(
-                {"_id": item["_id"]}, 
-                {"$set": {"ref_match": match_dict.to_dict(orient = "records")}})
-            continue
\ No newline at end of file
+    
+    # Match items without GPE (refnames, citynames and owners only) in one vectorized pass
+    # Same rules as _match_item, return ref_match (None if no match) of each item
+    def _match_vectorized(self, items, item_dates):
+        # One row per (item, id, type) of tags
+        tags = pd.DataFrame(
+            [(index, int(tag["id"]), tag["type"]) for index, item in enumerate(items) 
+             for tag in item["geo_tags"] + item["owner_tags"] 
+             if tag["type"] in ["refname", "cityname", "ownername"]], 
+            columns = ["item", "id", "type"])
+        has_owner = np.array([len(item["owner_tags"]) > 0 for item in items], dtype = bool)
+        # Number of types among refname and cityname of each item
+        n_types = tags[tags["type"].isin(["refname", "cityname"])].groupby(
+            "item")["type"].nunique().reindex(range(len(items)), fill_value = 0).to_numpy()
+        # Types of each (item, id)
+        tags["in_r"] = tags["type"] == "refname"
+        tags["in_c"] = tags["type"] == "cityname"
+        tags["in_o"] = tags["type"] == "ownername"
+        flags = tags.groupby(["item", "id"])[["in_r", "in_c", "in_o"]].any().reset_index()
+        # Ids from refname and city (in all types found among refname and cityname)
+        this_n_types = n_types[flags["item"].to_numpy()]
+        flags["in_rc"] = (((this_n_types == 1) & (flags["in_r"] | flags["in_c"])) | 
+                          ((this_n_types == 2) & flags["in_r"] & flags["in_c"]))
+        # Ids from owner, intersection with ids from refname and city if any
+        has_rc = flags.groupby("item")["in_rc"].any().reindex(
+            range(len(items)), fill_value = False).to_numpy()
+        flags["in_rco"] = np.where(has_rc[flags["item"].to_numpy()], 
+                                   flags["in_rc"] & flags["in_o"], flags["in_o"])
+        # Join with refineries, keep those active at date of item
+        candidates = flags.merge(
+            self.registry.refineries_df[["GeoAssetID", "FromDate", "ToDate"]].rename(
+                columns = {"GeoAssetID": "id"}).reset_index().rename(columns = {"index": "row"}), 
+            on = "id")
+        this_dates = item_dates[candidates["item"].to_numpy()]
+        candidates = candidates[(candidates["FromDate"].to_numpy() <= this_dates) & 
+                                (candidates["ToDate"].to_numpy() >= this_dates)]
+        # Number of refineries matched by refname, refname and city, owner
+        n_matchs = [candidates[candidates[i]].groupby("item").size().reindex(
+            range(len(items)), fill_value = 0).to_numpy() for i in ["in_r", "in_rc", "in_rco"]]
+        n_r, n_rc, n_rco = n_matchs
+        n_rco = np.where(has_owner, n_rco, 0)
+        # Perfect match at first step with 1 refinery, or all refineries from refname and city
+        # if no owner
+        match_type = np.select(
+            [n_r == 1, n_rc == 1, (n_rc > 1) & ~has_owner, n_rco == 1], 
+            ["in_r", "in_rc", "in_rc", "in_rco"], "")
+        # Otherwise match with less refineries
+        n_best = np.stack([np.where(i > 1, i, np.iinfo(np.int64).max) for i in n_matchs[:2]] + 
+                          [np.where(n_rco > 1, n_rco, np.iinfo(np.int64).max)])
+        best_type = np.array(["in_r", "in_rc", "in_rco"])[n_best.argmin(axis = 0)]
+        match_type = np.where((match_type == "") & (n_best.min(axis = 0) < np.iinfo(np.int64).max), 
+                              best_type, match_type)
+        # ref_match of each item, refineries of type matched in order of refineries_file
+        this_type = match_type[candidates["item"].to_numpy()]
+        candidates = candidates[((this_type == "in_r") & candidates["in_r"].to_numpy()) | 
+                                ((this_type == "in_rc") & candidates["in_rc"].to_numpy()) | 
+                                ((this_type == "in_rco") & candidates["in_rco"].to_numpy())]
+        results = [None for i in items]
+        for index, rows in candidates.sort_values("row").groupby("item")["row"]:
+            rows = rows.tolist()
+            results[index] = self.registry.ref_match(rows, round(1.0 / len(rows), 2))
+        return results
+    
+    # Match items, ref_match set in write_buffer
+    # Items without GPE are matched in one vectorized pass, others one by one (same signature once)
+    def match(self, items, date_key, write_buffer, pb = None):
+        batch_items = [i for i in items if not any([t["type"] == "GPE" for t in i["geo_tags"]])]
+        other_items = [i for i in items if any([t["type"] == "GPE" for t in i["geo_tags"]])]
+        if len(batch_items) > 0:
+            # Dates from MongoDb (datetime), converted at once
+            item_dates = np.array([i[date_key] for i in batch_items], dtype = "datetime64[ms]")
+            for item, ref_match in zip(batch_items, self._match_vectorized(batch_items, item_dates)):
+                if ref_match is not None:
+                    write_buffer.set(item["_id"], with_derived_fields({"ref_match": ref_match}))
+            self.n_items += len(batch_items)
+            self.n_vectorized += len(batch_items)
+            if pb is not None:
+                pb.update(len(batch_items))
+        for item in other_items:
+            item_date = item[date_key]
+            self.n_items += 1
+            signature = (tags_signature(item), self.registry.epoch(item_date))
+            if signature not in self.decisions.keys():
+                self.decisions[signature] = self._match_item(item, item_date)
+            if self.decisions[signature] is not None:
+                write_buffer.set(
+                    item["_id"], with_derived_fields({"ref_match": self.decisions[signature]}))
+            if pb is not None:
+                pb.update(1)
+
+
+# Objects of worker process, created once per process by _init_worker
+_worker = {}
+
+
+# Create MongoDb connection, refineries and GPEs cache of worker process
+def _init_worker(worker_params):
+    dbs_params = worker_params["dbs_params"]
+    # Own client per process, connections can't be shared with parent process
+    mydb = get_mongo_client(dbs_params)[dbs_params["mongoDB_Db"]]
+    mycol_refineries = mydb[dbs_params["mongoDB_Col_Refineries"]]
+    # Imported here, geopy only needed when matching
+    from geopy.geocoders import Nominatim
+    # Nominatim rate shared by all workers
+    gpe_cache_params = dict(worker_params["gpe_cache_params"])
+    gpe_cache_params["nominatim_rate_per_sec"] /= worker_params["n_workers"]
+    gpe_cache_params["nominatim_burst"] = max(
+        1, gpe_cache_params["nominatim_burst"] // worker_params["n_workers"])
+    gpe_cache = GPECache(mydb[dbs_params["mongoDB_Col_GPEs"]], 
+                         Nominatim(user_agent = worker_params["nominatim_user_agent"]), 
+                         **gpe_cache_params)
+    _worker["matcher"] = RefineryMatcher(
+        RefineryRegistry(worker_params["refineries_file"], mycol_refineries), 
+        RefineryPointIndex(mycol_refineries), gpe_cache)
+    _worker["write_buffer"] = WriteBuffer(
+        mydb[worker_params["items_col"]], worker_params["write_batch_size"], 
+        worker_params["match_fields"])
+    _worker["date_key"] = worker_params["date_key"]
+    _worker["read_batch_size"] = worker_params["read_batch_size"]
+
+
+# Match items of query in worker process
+# Return number of items, of items matched in vectorized pass and of new signatures
+def _match_range(query):
+    matcher = _worker["matcher"]
+    date_key = _worker["date_key"]
+    read_batch_size = _worker["read_batch_size"]
+    n_items = matcher.n_items
+    n_vectorized = matcher.n_vectorized
+    n_signatures = len(matcher.decisions)
+    with _worker["write_buffer"].mycol.find(
+            query, {"geo_tags": 1, "owner_tags": 1, date_key: 1}, 
+            batch_size = read_batch_size) as cursor:
+        for items in iter_chunks(cursor, read_batch_size):
+            matcher.match(items, date_key, _worker["write_buffer"])
+    _worker["write_buffer"].flush()
+    return (matcher.n_items - n_items, matcher.n_vectorized - n_vectorized, 
+            len(matcher.decisions) - n_signatures)
+
+
+# Split items of query in about n_ranges queries by range of _id, with about same number of
+# items each (ranges computed by MongoDb, _ids not loaded)
+def _id_ranges(mycol_items, query, n_ranges):
+    buckets = list(mycol_items.aggregate(
+        [{"$match": query}, {"$project": {"_id": 1}}, 
+         {"$bucketAuto": {"groupBy": "$_id", "buckets": n_ranges}}], 
+        allowDiskUse = True))
+    # Upper bound of each bucket is exclusive, except for last bucket
+    return [{**query, "_id": {"$gte": bucket["_id"]["min"], 
+                              ("$lt" if index < len(buckets) - 1 else "$lte"): bucket["_id"]["max"]}} 
+            for index, bucket in enumerate(buckets)]
+
+
+# GPEs in geo_tags of items of query (distinct, computed by MongoDb)
+def _pending_gpes(mycol_items, query):
+    return [i["_id"] for i in mycol_items.aggregate(
+        [{"$match": {**query, "geo_tags.type": "GPE"}}, {"$unwind": "$geo_tags"}, 
+         {"$match": {"geo_tags.type": "GPE"}}, {"$group": {"_id": "$geo_tags.match"}}], 
+        allowDiskUse = True)]
+
+
+# Get probabilities of match for refineries, items read and matched by chunks of read_batch_size
+# If n_workers > 1 items are split by _id ranges and matched in n_workers processes, each
+# process creating its own objects from worker_params (iLox.get_match_worker_params)
+# If check_plans, warn if queries of items to match are not served by an index (raise
+# CollScanError if strict_plans)
+def get_match_proba(registry, mycol_items, point_index, gpe_cache, display_pb, 
+                    match_start, date_key, write_batch_size = 1000, match_filter = None, 
+                    match_fields = None, n_workers = 1, worker_params = None, 
+                    read_batch_size = 10000, check_plans = False, 
+                    strict_plans = False):
+    
+    # Additional conditions on items to match (e.g. not matched yet in incremental mode)
+    if match_filter is None:
+        match_filter = {}
+    # Items with at least 1 geo_tag, unmatched yet and according to timeframe
+    query_geo_tags = {date_key: {"$gte": match_start}, "has_geo_tags": True, 
+                      "n_ref_match": 0, **match_filter}
+    # Items with owner_tag but no geo_tag
+    query_owner_tags = {date_key: {"$gte": match_start}, "has_geo_tags": False, 
+                        "has_owner_tags": True, **match_filter}
+    if check_plans:
+        check_query_plan(mycol_items, query_geo_tags, strict_plans)
+        check_query_plan(mycol_items, query_owner_tags, strict_plans)
+    
+    # Resolve polygons of all GPEs before matching, matching then only reads from cache (or 
+    # from GPEs collection in worker processes)
+    gpe_cache.prefetch(_pending_gpes(mycol_items, query_geo_tags), display_pb)
+    queries = [(query_geo_tags, "Matching to refineries"), 
+               (query_owner_tags, "Matching to refineries (only owner_tags)")]
+    if n_workers <= 1:
+        # Matchs are written in bulk, match_fields are set with every match
+        write_buffer = WriteBuffer(mycol_items, write_batch_size, match_fields)
+        matcher = RefineryMatcher(registry, point_index, gpe_cache)
+        for query, desc in queries:
+            with tqdm(total = mycol_items.count_documents(query), disable = display_pb, 
+                      desc = desc, leave = True) as pb:
+                with mycol_items.find(query, {"geo_tags": 1, "owner_tags": 1, date_key: 1}, 
+                                      batch_size = read_batch_size) as cursor:
+                    for match_items in iter_chunks(cursor, read_batch_size):
+                        matcher.match(match_items, date_key, write_buffer, pb)
+        # Write remaining matchs
+        write_buffer.flush()
+        n_items = matcher.n_items
+        n_vectorized = matcher.n_vectorized
+        n_signatures = len(matcher.decisions)
+    else:
+        # Tasks of about 1/8 of items per worker (at least 100 items), by range of _id
+        tasks = []
+        n_total = 0
+        for query, desc in queries:
+            n_query = mycol_items.count_documents(query)
+            n_total += n_query
+            if n_query > 0:
+                tasks.extend(_id_ranges(
+                    mycol_items, query, max(1, min(n_workers * 8, n_query // 100))))
+        n_items = 0
+        n_vectorized = 0
+        n_signatures = 0
+        with Pool(n_workers, initializer = _init_worker, initargs = ({
+                **worker_params, "n_workers": n_workers, "items_col": mycol_items.name, 
+                "date_key": date_key, "write_batch_size": write_batch_size, 
+                "read_batch_size": read_batch_size, "match_fields": match_fields}, )) as pool:
+            with tqdm(total = n_total, disable = display_pb, 
+                      desc = "Matching to refineries (%r processes)" % n_workers, 
+                      leave = True) as pb:
+                for task_items, task_vectorized, task_signatures in pool.imap_unordered(
+                        _match_range, tasks):
+                    n_items += task_items
+                    n_vectorized += task_vectorized
+                    n_signatures += task_signatures
+                    pb.update(task_items)
+    
+    # Items with GPEs matched one by one, once per signature
+    n_gpes = n_items - n_vectorized
+    print("Match decisions: %r items, %r in vectorized pass, %r with GPEs: %r signatures, "
+          "%r from memory (%.1f%%)" % (
+              n_items, n_vectorized, n_gpes, n_signatures, n_gpes - n_signatures, 
+              100.0 * (n_gpes - n_signatures) / max(n_gpes, 1)))
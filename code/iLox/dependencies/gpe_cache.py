@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Jul 19 21:37:15 2021
+
+@author: brend
+"""
+
+import time
+import warnings
+import pymongo
+from tqdm import tqdm
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from area import area
+from iLox.dependencies.rate_limiter import RateLimiter, RateLimitedGeolocator
+from iLox.dependencies.chunks import iter_chunks
+
+
+# Query location on Nominatim
+# With exactly_one = False, return [] if Nominatim answered without any location and None if
+# all attempts failed
+def query_nominatim(geolocator, gpe, max_attempts = 10, wait_error = 5, wait = 0.5,
+                    exactly_one = True):
+    # Imported here, geopy only needed when querying Nominatim
+    from geopy.exc import GeocoderUnavailable, GeocoderServiceError
+    # Try max_attempts times
+    for i in range(max_attempts):
+        try:
+            geo_data = geolocator.geocode(
+                gpe, geometry = "geojson", language = "en", exactly_one = exactly_one)
+            # Wait normal wait time per request
+            time.sleep(wait)
+            # If successful then return output
+            if geo_data is None and not exactly_one:
+                return []
+            return geo_data
+        # Otherwise wait wait_error seconds
+        except GeocoderUnavailable:
+            time.sleep(wait_error)
+        # Sometimes exactly_one = False creates GeocoderServiceError, retry with True
+        except GeocoderServiceError:
+            time.sleep(wait)
+            try:
+                geo_data = geolocator.geocode(
+                    gpe, geometry = "geojson", language = "en", exactly_one = True)
+                # Wait normal wait time per request
+                time.sleep(wait)
+                # If successful then return output
+                return [geo_data] if geo_data is not None else []
+            # Otherwise wait wait_error seconds
+            except (GeocoderUnavailable, GeocoderServiceError):
+                time.sleep(wait_error)
+    # If exit loop after trying max_attempts times then try request for Paris
+    try:
+        geo_data = geolocator.geocode(
+            "Paris", geometry = "geojson", language = "en")
+        # If request is successful return None, will continue with next gpe
+        return None
+    # Otherwise raise error, means Nominatim API is down, break execution
+    except GeocoderUnavailable:
+        raise
+
+
+class GPECache():
+
+    def __init__(self, mycol_gpes, geolocator, max_size = 10000, negative_ttl_days = 30,
+                 nominatim_max_attempts = 10, nominatim_wait_error = 5, nominatim_rate_per_sec = 1.0,
+                 nominatim_burst = 1, nominatim_max_workers = 4):
+
+        """
+        Polygons of GPEs, looked up in memory first, then in GPEs collection, then on Nominatim
+        (results saved in GPEs collection). GPEs without any polygon on Nominatim are saved too
+        (not_found) and queried again only once expired
+        Args:
+            * mycol_gpes (pymongo.Collection): MongoDb collection of GPEs polygons
+            * geolocator (geopy.geocoders.Nominatim): Geolocator used for GPEs not in collection,
+              any object with the same geocode method can be used (e.g. local stub)
+            * max_size (int): Maximum number of GPEs kept in memory, least recently used removed first
+            * negative_ttl_days (int): Days before GPE not found on Nominatim is queried again
+            * nominatim_max_attempts (int): Attempts per Nominatim query
+            * nominatim_wait_error (float): Seconds to wait after Nominatim error
+            * nominatim_rate_per_sec (float): Nominatim queries per second, shared by all threads
+            * nominatim_burst (int): Nominatim queries allowed at once
+            * nominatim_max_workers (int): Nominatim queries in flight when prefetching GPEs
+        """
+
+        self.mycol_gpes = mycol_gpes
+        self.geolocator = geolocator
+        self.max_size = max_size
+        self.negative_ttl_days = negative_ttl_days
+        self.nominatim_max_attempts = nominatim_max_attempts
+        self.nominatim_wait_error = nominatim_wait_error
+        self.nominatim_max_workers = nominatim_max_workers
+        self.rate_limiter = RateLimiter(nominatim_rate_per_sec, nominatim_burst)
+        self.polygons = OrderedDict()
+        # Set when Nominatim is down, GPEs not in collection are then skipped until next run
+        self.nominatim_down = False
+        self.n_memory = 0
+        self.n_db = 0
+        self.n_nominatim = 0
+        self.n_not_found = 0
+        # Create indexes if not already exist, not_found entries removed by MongoDb once expired
+        existing_idx = self.mycol_gpes.index_information()
+        if "GPEs" not in existing_idx.keys():
+            self.mycol_gpes.create_index(
+                [("GPEs", pymongo.ASCENDING)], name = "GPEs", unique = False)
+        if "not_found" not in existing_idx.keys():
+            self.mycol_gpes.create_index(
+                [("not_found", pymongo.ASCENDING)], name = "not_found", unique = False)
+        if "expires_at" not in existing_idx.keys():
+            self.mycol_gpes.create_index(
+                [("expires_at", pymongo.ASCENDING)], name = "expires_at", expireAfterSeconds = 0)
+
+    # Get polygons of GPE, list of {"id", "boundaries", "area"} by decreasing importance
+    def get(self, gpe):
+        if gpe in self.polygons.keys():
+            self.polygons.move_to_end(gpe)
+            self.n_memory += 1
+            return self.polygons[gpe]
+        polygons = self._load(gpe)
+        # Not cached if Nominatim is down
+        if polygons is None:
+            return []
+        self._remember(gpe, polygons)
+        return polygons
+
+    # Load polygons of all GPEs in memory before matching, GPEs not in GPEs collection are
+    # queried on Nominatim concurrently (rate limited) and saved in collection
+    def prefetch(self, gpes, display_pb = False):
+        from geopy.exc import GeocoderUnavailable
+        gpes_docs = {gpe: [] for gpe in set(gpes) if gpe not in self.polygons.keys()}
+        # GPEs already in collection (with polygons or not_found)
+        found = set()
+        for these_gpes in iter_chunks(list(gpes_docs.keys()), 10000):
+            for gpe_doc in self.mycol_gpes.find(
+                    {"$or": [{"GPEs": {"$in": these_gpes}},
+                             {"not_found": {"$in": these_gpes},
+                              "expires_at": {"$gt": datetime.utcnow()}}]},
+                    {"GPEs": 1, "not_found": 1, "boundaries": 1, "importance": 1}):
+                if "not_found" in gpe_doc.keys():
+                    found.add(gpe_doc["not_found"])
+                    continue
+                for gpe in gpe_doc["GPEs"]:
+                    if gpe in gpes_docs.keys():
+                        gpes_docs[gpe].append(gpe_doc)
+                        found.add(gpe)
+        for gpe in found:
+            self.n_db += 1
+            self._remember(gpe, self._to_polygons(gpes_docs[gpe]))
+        # Other GPEs queried on Nominatim, results saved from this thread as they come
+        new_gpes = [gpe for gpe in gpes_docs.keys() if gpe not in found]
+        if len(new_gpes) == 0 or self.nominatim_down:
+            return
+        with ThreadPoolExecutor(max_workers = self.nominatim_max_workers) as executor:
+            futures = {executor.submit(self._fetch, gpe): gpe for gpe in new_gpes}
+            for future in tqdm(as_completed(futures), total = len(futures),
+                               disable = display_pb,
+                               desc = "Querying GPEs on Nominatim",
+                               leave = True):
+                try:
+                    geo_data = future.result()
+                except GeocoderUnavailable:
+                    # Queries not started yet then fail immediately
+                    if not self.nominatim_down:
+                        warnings.warn("Nominatim API is down")
+                        self.nominatim_down = True
+                    continue
+                self._remember(futures[future], self._save(futures[future], geo_data))
+
+    # Keep polygons of GPE in memory, remove least recently used GPE above max_size
+    def _remember(self, gpe, polygons):
+        self.polygons[gpe] = polygons
+        self.polygons.move_to_end(gpe)
+        if len(self.polygons) > self.max_size:
+            self.polygons.popitem(last = False)
+
+    # Load polygons of GPE from GPEs collection, or from Nominatim if never queried
+    def _load(self, gpe):
+        gpe_docs = list(self.mycol_gpes.find(
+            {"$or": [{"GPEs": gpe},
+                     {"not_found": gpe, "expires_at": {"$gt": datetime.utcnow()}}]},
+            {"boundaries": 1, "importance": 1}))
+        if len(gpe_docs) > 0:
+            self.n_db += 1
+            return self._to_polygons([i for i in gpe_docs if "boundaries" in i.keys()])
+        if self.nominatim_down:
+            return None
+        from geopy.exc import GeocoderUnavailable
+        try:
+            geo_data = self._fetch(gpe)
+        except GeocoderUnavailable:
+            warnings.warn("Nominatim API is down")
+            self.nominatim_down = True
+            return None
+        return self._save(gpe, geo_data)
+
+    # Query GPE on Nominatim (rate limited, safe to call from several threads)
+    # Raise GeocoderUnavailable if Nominatim is down
+    def _fetch(self, gpe):
+        from geopy.exc import GeocoderUnavailable
+        if self.nominatim_down:
+            raise GeocoderUnavailable("Nominatim API is down")
+        return query_nominatim(RateLimitedGeolocator(self.geolocator, self.rate_limiter), gpe,
+                               self.nominatim_max_attempts, self.nominatim_wait_error, 0,
+                               exactly_one = False)
+
+    # Save polygons found on Nominatim (or GPE as not_found) in GPEs collection
+    # geo_data None (all attempts failed) is not saved, GPE queried again on next run
+    def _save(self, gpe, geo_data):
+        self.n_nominatim += 1
+        if geo_data is None:
+            return []
+        gpe_docs = []
+        geo_data = [i for i in geo_data if "geojson" in i.raw.keys() and
+                    i.raw["geojson"]["type"] not in ["Point", "LineString", "MultiLineString"]]
+        for this_geo_data in geo_data:
+            this_geo_data.raw["GPEs"] = list(set(
+                [gpe, this_geo_data.raw["display_name"].split(",")[0].strip()]))
+            # If this location (from boundaries) already in database, add GPE to GPEs of that location
+            existing_doc = self.mycol_gpes.find_one_and_update(
+                {"boundaries": this_geo_data.raw["geojson"]}, {"$push": {"GPEs": gpe}},
+                {"boundaries": 1, "importance": 1})
+            if existing_doc is not None:
+                gpe_docs.append(existing_doc)
+                continue
+            # Else format to save in database
+            keep_keys = ["class", "display_name", "geojson", "importance", "lat", "lon",
+                         "osm_id", "osm_type", "place_id", "type", "GPEs"]
+            this_geo_data = {k: this_geo_data.raw[k] for k in keep_keys if
+                             k in this_geo_data.raw.keys()}
+            this_geo_data["point"] = {
+                "type": "Point", "coordinates": [float(this_geo_data.pop("lon")),
+                                                 float(this_geo_data.pop("lat"))]}
+            this_geo_data["boundaries"] = this_geo_data.pop("geojson")
+            # Insert in MongoDb (_id set by insert_one)
+            try:
+                self.mycol_gpes.insert_one(this_geo_data)
+            except pymongo.errors.DuplicateKeyError:
+                pass
+            gpe_docs.append(this_geo_data)
+        # If Nominatim answered without polygon then save GPE as not found, not queried again
+        # until expired
+        if len(gpe_docs) == 0:
+            self.n_not_found += 1
+            self.mycol_gpes.insert_one(
+                {"not_found": gpe,
+                 "expires_at": datetime.utcnow() + timedelta(days = self.negative_ttl_days)})
+        return self._to_polygons(gpe_docs)
+
+    # Polygons of GPEs documents, by decreasing importance
+    def _to_polygons(self, gpe_docs):
+        gpe_docs = sorted(gpe_docs, key = lambda i: i.get("importance") or 0, reverse = True)
+        return [{"id": i["_id"], "boundaries": i["boundaries"], "area": area(i["boundaries"])}
+                for i in gpe_docs]
+
+    def stats(self):
+        return "GPE cache: %r from memory, %r from database, %r Nominatim queries (%r not found)" % (
+            self.n_memory, self.n_db, self.n_nominatim, self.n_not_found)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jul 27 21:36:04 2021
+
+@author: brend
+"""
+
+import pymongo
+import warnings
+import pandas as pd
+from datetime import datetime, timezone
+
+
+# Format of created_at of Tweets returned by Twitter (e.g. "Wed Jul 14 10:00:00 +0000 2021")
+TWITTER_DATE_FORMAT = "%a %b %d %H:%M:%S %z %Y"
+
+MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+# ISO dates with at least milliseconds, e.g. "%Y-%m-%dT%H:%M:%S.%fZ" (microseconds) used to
+# store dates as strings, not parsed by $dateFromString (milliseconds only)
+ISO_DATE_REGEX = r"^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d{3,}Z$"
+
+
+# Date (str, e.g. start parameters) to datetime, naive UTC as returned by MongoDb
+def to_datetime(value):
+    value = pd.Timestamp(value)
+    if value.tzinfo is not None:
+        value = value.tz_convert("UTC").tz_localize(None)
+    return value.to_pydatetime()
+
+
+# Twitter date (str) to datetime, naive UTC as returned by MongoDb
+def from_twitter_date(value):
+    return datetime.strptime(value, TWITTER_DATE_FORMAT).astimezone(timezone.utc).replace(
+        tzinfo = None)
+
+
+# Aggregation expression converting string date of field to date, Twitter format (contains
+# spaces), ISO format with microseconds or milliseconds (e.g. "2021-07-14T10:00:00.000000Z",
+# truncated to milliseconds) or other formats parsed by MongoDb, dates failing to convert kept as is
+def _date_expression(field):
+    value = "$" + field
+    twitter_date = {"$dateFromParts": {
+        "year": {"$toInt": {"$substrBytes": [value, 26, 4]}},
+        "month": {"$add": [{"$indexOfArray": [MONTHS, {"$substrBytes": [value, 4, 3]}]}, 1]},
+        "day": {"$toInt": {"$substrBytes": [value, 8, 2]}},
+        "hour": {"$toInt": {"$substrBytes": [value, 11, 2]}},
+        "minute": {"$toInt": {"$substrBytes": [value, 14, 2]}},
+        "second": {"$toInt": {"$substrBytes": [value, 17, 2]}},
+        "timezone": {"$substrBytes": [value, 20, 5]}}}
+    iso_date = {"$dateFromParts": {
+        "year": {"$toInt": {"$substrBytes": [value, 0, 4]}},
+        "month": {"$toInt": {"$substrBytes": [value, 5, 2]}},
+        "day": {"$toInt": {"$substrBytes": [value, 8, 2]}},
+        "hour": {"$toInt": {"$substrBytes": [value, 11, 2]}},
+        "minute": {"$toInt": {"$substrBytes": [value, 14, 2]}},
+        "second": {"$toInt": {"$substrBytes": [value, 17, 2]}},
+        "millisecond": {"$toInt": {"$substrBytes": [value, 20, 3]}}}}
+    other_date = {"$dateFromString": {"dateString": value, "onError": value}}
+    return {"$switch": {
+        "branches": [
+            {"case": {"$regexMatch": {"input": value, "regex": " "}}, "then": twitter_date},
+            {"case": {"$regexMatch": {"input": value, "regex": ISO_DATE_REGEX}}, "then": iso_date}],
+        "default": other_date}}
+
+
+# Convert string dates of date_key to dates, in MongoDb with a single pipeline update
+# unset_fields (list) are removed from items converted (e.g. fields computed from string date)
+# Return number of items converted
+def migrate_dates(mycol, date_key, unset_fields = None):
+    pipeline = [{"$set": {date_key: _date_expression(date_key)}}]
+    if unset_fields is not None and len(unset_fields) > 0:
+        pipeline.append({"$unset": unset_fields})
+    return mycol.update_many({date_key: {"$type": "string"}}, pipeline).modified_count
+
+
+# Create index on date_key if not already exists, convert string dates (items inserted before
+# dates were stored as dates)
+def prep_dates(mycol, date_key, unset_fields = None):
+    existing_idx = mycol.index_information()
+    if date_key not in existing_idx.keys():
+        mycol.create_index(
+            [(date_key, pymongo.ASCENDING)], name = date_key, unique = False)
+    n_converted = migrate_dates(mycol, date_key, unset_fields)
+    if n_converted > 0:
+        print("%s: %r %s converted to dates" % (mycol.name, n_converted, date_key))
+    # Strings left are not matched by date range queries
+    n_strings = mycol.count_documents({date_key: {"$type": "string"}})
+    if n_strings > 0:
+        warnings.warn("%s: %r %s failed to convert to dates" % (mycol.name, n_strings, date_key))
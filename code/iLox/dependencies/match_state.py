@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jul 13 21:08:52 2021
+
+@author: brend
+"""
+
+import os
+import json
+import hashlib
+import pymongo
+
+
+# Increase when matching logic changes, all items are then matched again
+MATCHER_VERSION = 2
+
+# Matching stages, match_stage field of an item is the last stage completed
+STAGE_RESET = 0
+STAGE_NAMES = 1
+STAGE_NLP = 2
+STAGE_REFINERIES = 3
+STAGE_COUNTRIES = 4
+STAGE_EVENTS = 5
+STAGE_MERGED = 6
+
+# Fields derived from arrays of items (derived field: array), n_ fields count items of array, 
+# has_ fields are True if array not empty. Queries on $size of arrays can't use indexes, 
+# queries on derived fields can
+DERIVED_FIELDS = {"has_geo_tags": "geo_tags", "has_owner_tags": "owner_tags", 
+                  "n_ref_match": "ref_match", "has_events": "events_tags"}
+
+
+# Hash of matcher version, content of input files and other parameters used to match
+def inputs_fingerprint(files, *params):
+    fingerprint = hashlib.sha1(("%r" % MATCHER_VERSION).encode("utf-8"))
+    for file in files:
+        fingerprint.update(file.encode("utf-8"))
+        if not os.path.exists(file):
+            continue
+        with open(file, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                fingerprint.update(block)
+    fingerprint.update(json.dumps(params, sort_keys = True, default = str).encode("utf-8"))
+    return fingerprint.hexdigest()
+
+
+# Query for items matched with current inputs not yet processed by stage
+def pending_filter(fingerprint, stage):
+    return {"match_fingerprint": fingerprint, "match_stage": {"$lt": stage}}
+
+
+# Set stage as completed for all items of query (including those without any match)
+def complete_stage(mycol, query, stage):
+    mycol.update_many(query, {"$set": {"match_stage": stage}})
+
+
+# Fields (dict) with derived fields of arrays in fields added, to set together
+def with_derived_fields(fields):
+    derived = {k: len(fields[v]) if k.startswith("n_") else len(fields[v]) > 0 
+               for k, v in DERIVED_FIELDS.items() if v in fields.keys()}
+    return {**fields, **derived}
+
+
+# Compound indexes on derived fields (list of fields), date of items last as it's queried by range
+# Used by matching (items with geo_tags not matched yet), events and merge (items with events)
+def derived_indexes(date_key):
+    return [["match_fingerprint", "has_geo_tags", "n_ref_match", "match_stage", date_key], 
+            ["has_events", "match_stage", "n_ref_match", date_key]]
+
+
+# Create indexes on derived fields if not already exist, set derived fields of items matched 
+# before they existed (all derived fields are set together)
+def prep_derived_fields(mycol, date_key):
+    existing_idx = mycol.index_information()
+    for fields in derived_indexes(date_key):
+        if "_".join(fields) not in existing_idx.keys():
+            mycol.create_index(
+                [(i, pymongo.ASCENDING) for i in fields], name = "_".join(fields), unique = False)
+    mycol.update_many(
+        {"has_events": {"$exists": False}}, 
+        [{"$set": {k: {"$size": {"$ifNull": ["$" + v, []]}} if k.startswith("n_") else 
+                   {"$gt": [{"$size": {"$ifNull": ["$" + v, []]}}, 0]} 
+                   for k, v in DERIVED_FIELDS.items()}}])
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Jul 24 16:40:12 2021
+
+@author: brend
+"""
+
+import json
+import hashlib
+import pymongo
+from pymongo import UpdateOne
+from iLox.dependencies.bulk_writer import BulkWriter
+from iLox.dependencies.item_dates import prep_dates
+
+
+# Fields of merged collection, in order
+MERGED_FIELDS = ["id", "created_at", "text", "snippet", "source_id", "retweet_count",
+                 "favorite_count", "reply_count", "quote_count", "favorited", "retweeted",
+                 "entities", "geo_tags", "owner_tags", "ref_match", "events_tags",
+                 "country_match", "cluster_id"]
+
+# Fields of merged collection set when item is inserted only, then written by clustering
+INSERT_ONLY_FIELDS = ["cluster_id"]
+
+
+# Hash of date and content of item, same items (e.g. retweets at same time) merged only once
+def content_hash(item):
+    return hashlib.sha1(json.dumps(
+        [item.get("created_at"), item.get("text"), item.get("snippet")], default = str
+        ).encode("utf-8")
+        ).hexdigest()
+
+
+# Create indexes of merged collection if not already exist, content_hash of items merged
+# before it existed set once (and again for items merged with string dates, converted to dates)
+def prep_merged_col(mycol_merged, batch_size = 1000, read_batch_size = 10000):
+    existing_idx = mycol_merged.index_information()
+    if "id" not in existing_idx.keys():
+        mycol_merged.create_index(
+            [("id", pymongo.ASCENDING)], name = "id", unique = True)
+    if "content_hash" not in existing_idx.keys():
+        mycol_merged.create_index(
+            [("content_hash", pymongo.ASCENDING)], name = "content_hash", unique = True,
+            partialFilterExpression = {"content_hash": {"$exists": True}})
+    prep_dates(mycol_merged, "created_at", ["content_hash"])
+    writer = BulkWriter(mycol_merged, batch_size)
+    with mycol_merged.find({"content_hash": {"$exists": False}}, 
+                           {"created_at": 1, "text": 1, "snippet": 1}, 
+                           batch_size = read_batch_size) as cursor:
+        for item in cursor:
+            writer.write(UpdateOne(
+                {"_id": item["_id"]}, {"$set": {"content_hash": content_hash(item)}}))
+    writer.close()
+
+
+# Upsert items (by id) of query from source collection into merged collection, keys of source
+# items renamed with convert_keys, items with same content_hash as another item skipped
+# Source items streamed by batches of read_batch_size, written by batches of batch_size
+# Return BulkWriter (with counts of items upserted, modified and duplicates)
+def merge_items(mycol_source, mycol_merged, query, convert_keys, batch_size = 1000,
+                read_batch_size = 10000):
+    writer = BulkWriter(mycol_merged, batch_size)
+    with mycol_source.find(query, {**{k: 1 for k in convert_keys.keys()}, "_id": 0},
+                           batch_size = read_batch_size) as cursor:
+        for item in cursor:
+            item = {convert_keys[k]: v for k, v in item.items()}
+            # Fields missing in source set to None when inserted only (e.g. cluster_id of Tweets),
+            # insert only fields never overwritten (cluster_id set by clustering)
+            insert_only = {k: item.pop(k, None) for k in INSERT_ONLY_FIELDS}
+            writer.write(UpdateOne(
+                {"id": item["id"]},
+                {"$set": {**item, "content_hash": content_hash(item)},
+                 "$setOnInsert": {**{k: None for k in MERGED_FIELDS if k not in item.keys()},
+                                  **insert_only}},
+                upsert = True))
+    writer.close()
+    return writer
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Jul 25 18:27:54 2021
+
+@author: brend
+"""
+
+from pymongo import MongoClient
+
+
+# MongoDb client from databases params, one connection pool shared by all collections
+# Compressors not installed (zstandard, python-snappy) are skipped by pymongo with a warning
+def get_mongo_client(dbs_params):
+    return MongoClient(
+        dbs_params["mongoDB_Host"], 
+        dbs_params["mongoDB_Port"], 
+        maxPoolSize = dbs_params["mongoDB_Max_Pool_Size"], 
+        minPoolSize = dbs_params["mongoDB_Min_Pool_Size"], 
+        connectTimeoutMS = dbs_params["mongoDB_Connect_Timeout_MS"], 
+        serverSelectionTimeoutMS = dbs_params["mongoDB_Server_Selection_Timeout_MS"], 
+        socketTimeoutMS = dbs_params["mongoDB_Socket_Timeout_MS"], 
+        compressors = dbs_params["mongoDB_Compressors"])
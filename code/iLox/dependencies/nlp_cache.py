@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Jul 17 16:02:44 2021
+
+@author: brend
+"""
+
+import hashlib
+import pymongo
+from pymongo import UpdateOne, DeleteMany
+from datetime import datetime
+from iLox.dependencies.chunks import iter_chunks
+
+
+class NLPCache():
+
+    def __init__(self, mycol, max_entries = 2000000):
+
+        """
+        Persistent cache of entities extracted with Spacy, avoid parsing the same text again
+        (retweets, syndicated headlines, re-runs)
+        Args:
+            * mycol (pymongo.Collection): MongoDb collection to store the entities
+            * max_entries (int): Maximum number of texts in cache, least recently used removed first
+        """
+
+        self.mycol = mycol
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        # Create indexes if not already exist
+        existing_idx = self.mycol.index_information()
+        if "last_used" not in existing_idx.keys():
+            self.mycol.create_index(
+                [("last_used", pymongo.ASCENDING)], name = "last_used", unique = False)
+
+    # Key of text, hash of model (name and version) and text with normalized whitespaces
+    def key(self, model_key, text):
+        return hashlib.sha1(
+            (model_key + "\n" + " ".join(text.split())).encode("utf-8")).hexdigest()
+
+    # Get cached entities for keys, return {key: [(text, label)]} for keys found
+    def get_many(self, keys):
+        found = {i["_id"]: [tuple(e) for e in i["entities"]] for i in self.mycol.find(
+            {"_id": {"$in": list(set(keys))}}, {"entities": 1})}
+        if len(found) > 0:
+            self.mycol.update_many(
+                {"_id": {"$in": list(found.keys())}}, {"$set": {"last_used": datetime.utcnow()}})
+        self.hits += len([k for k in keys if k in found.keys()])
+        self.misses += len([k for k in keys if k not in found.keys()])
+        return found
+
+    # Save entities {key: [(text, label)]} in cache
+    def put_many(self, entities):
+        if len(entities) == 0:
+            return
+        now = datetime.utcnow()
+        self.mycol.bulk_write(
+            [UpdateOne({"_id": k}, {"$set": {"entities": [list(e) for e in v], "last_used": now}},
+                       upsert = True) for k, v in entities.items()],
+            ordered = False)
+
+    # Remove least recently used texts above max_entries
+    def evict(self):
+        n_evict = self.mycol.estimated_document_count() - self.max_entries
+        if n_evict <= 0:
+            return
+        evict_ids = [i["_id"] for i in self.mycol.find(
+            {}, {"_id": 1}).sort([("last_used", pymongo.ASCENDING)]).limit(n_evict)]
+        self.mycol.bulk_write(
+            [DeleteMany({"_id": {"$in": i}}) for i in iter_chunks(evict_ids, 10000)],
+            ordered = False)
+
+    def stats(self):
+        return "NLP cache: %r hits, %r misses" % (self.hits, self.misses)
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Jul 21 22:04:31 2021
+
+@author: brend
+"""
+
+import numpy as np
+
+
+# Maximum number of (point, edge) pairs tested at once
+MAX_PAIRS = 2000000
+
+
+# Whether points (x, y arrays) are inside ring (array of [lon, lat]), even-odd ray casting
+def _in_ring(x, y, ring):
+    if not np.array_equal(ring[0], ring[-1]):
+        ring = np.vstack([ring, ring[:1]])
+    x1, y1 = ring[:-1, 0], ring[:-1, 1]
+    x2, y2 = ring[1:, 0], ring[1:, 1]
+    inside = np.zeros(len(x), dtype = bool)
+    # Points processed by chunks to limit memory with large rings
+    step = max(1, MAX_PAIRS // len(x1))
+    for start in range(0, len(x), step):
+        px = x[start:start + step, None]
+        py = y[start:start + step, None]
+        # Edges crossing horizontal line of point, on the right of point
+        crosses = (y1 > py) != (y2 > py)
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            x_cross = x1 + (py - y1) * (x2 - x1) / (y2 - y1)
+        inside[start:start + step] = (crosses & (px < x_cross)).sum(axis = 1) % 2 == 1
+    return inside
+
+
+class RefineryPointIndex():
+
+    def __init__(self, mycol_refineries):
+
+        """
+        Refineries points loaded once in memory, refineries within polygons are found locally
+        (bounding box prefilter then exact test on rings) instead of $geoWithin queries
+        Args:
+            * mycol_refineries (pymongo.Collection): MongoDb collection of refineries (with point)
+        """
+
+        points = list(mycol_refineries.find(
+            {"point": {"$exists": True}}, {"GeoAssetID": 1, "point": 1, "_id": 0}))
+        self.ids = np.array([i["GeoAssetID"] for i in points])
+        coordinates = np.array(
+            [i["point"]["coordinates"] for i in points], dtype = float).reshape(-1, 2)
+        self.lon = coordinates[:, 0]
+        self.lat = coordinates[:, 1]
+        # GeoAssetIDs within each polygon already processed, by polygon id
+        self.within_polygons = {}
+        self.n_hits = 0
+        self.n_computed = 0
+
+    # GeoAssetIDs of refineries within polygon (GeoJSON Polygon or MultiPolygon)
+    # Result saved for polygon_id (e.g. _id in GPEs collection)
+    def within(self, polygon_id, polygon):
+        if polygon_id in self.within_polygons.keys():
+            self.n_hits += 1
+            return self.within_polygons[polygon_id]
+        self.n_computed += 1
+        self.within_polygons[polygon_id] = self._within(polygon)
+        return self.within_polygons[polygon_id]
+
+    def _within(self, polygon):
+        if polygon["type"] == "Polygon":
+            all_rings = [polygon["coordinates"]]
+        elif polygon["type"] == "MultiPolygon":
+            all_rings = polygon["coordinates"]
+        else:
+            return []
+        inside = np.zeros(len(self.ids), dtype = bool)
+        for rings in all_rings:
+            outer = np.asarray(rings[0], dtype = float)
+            # Points not inside yet and within bounding box of outer ring
+            candidates = np.flatnonzero(
+                ~inside &
+                (self.lon >= outer[:, 0].min()) & (self.lon <= outer[:, 0].max()) &
+                (self.lat >= outer[:, 1].min()) & (self.lat <= outer[:, 1].max()))
+            if len(candidates) == 0:
+                continue
+            lon = self.lon[candidates]
+            lat = self.lat[candidates]
+            # Inside outer ring and not inside any hole
+            this_inside = _in_ring(lon, lat, outer)
+            for hole in rings[1:]:
+                this_inside &= ~_in_ring(lon, lat, np.asarray(hole, dtype = float))
+            inside[candidates] = this_inside
+        return self.ids[inside].tolist()
+
+    def stats(self):
+        return "Refineries within polygons: %r computed, %r from memory" % (
+            self.n_computed, self.n_hits)
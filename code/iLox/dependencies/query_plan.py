@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Jul 26 20:17:45 2021
+
+@author: brend
+"""
+
+import warnings
+
+
+class CollScanError(Exception):
+    pass
+
+
+# Stages of plan (dict), including input stages
+def _plan_stages(plan):
+    stages = [plan["stage"]] if "stage" in plan.keys() else []
+    for key in ["inputStage", "queryPlan"]:
+        if isinstance(plan.get(key), dict):
+            stages.extend(_plan_stages(plan[key]))
+    for key in ["inputStages", "shards"]:
+        if isinstance(plan.get(key), list):
+            for this_plan in plan[key]:
+                stages.extend(_plan_stages(this_plan.get("winningPlan", this_plan)))
+    return stages
+
+
+# Stages of winning plan of query (query only planned, not executed)
+def query_stages(mycol, query):
+    explain = mycol.database.command(
+        {"explain": {"find": mycol.name, "filter": query}, "verbosity": "queryPlanner"})
+    return _plan_stages(explain["queryPlanner"]["winningPlan"])
+
+
+# Warn if query would scan whole collection instead of an index, raise CollScanError if strict
+def check_query_plan(mycol, query, strict = False):
+    stages = query_stages(mycol, query)
+    if "COLLSCAN" in stages:
+        message = "%s: query %r not served by an index (plan: %s)" % (
+            mycol.name, query, " <- ".join(stages))
+        if strict:
+            raise CollScanError(message)
+        warnings.warn(message)
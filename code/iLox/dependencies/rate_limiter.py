@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jul 20 20:12:48 2021
+
+@author: brend
+"""
+
+import time
+import threading
+
+
+class RateLimiter():
+
+    def __init__(self, rate_per_sec = 1.0, burst = 1):
+
+        """
+        Token bucket shared by threads, allows burst calls at once then rate_per_sec calls per second
+        Args:
+            * rate_per_sec (float): Calls allowed per second on average
+            * burst (int): Maximum number of calls allowed at once
+        """
+
+        self.rate_per_sec = rate_per_sec
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Wait until call is allowed
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate_per_sec)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate_per_sec
+            time.sleep(wait)
+
+
+# Geolocator waiting for rate limiter before each query
+class RateLimitedGeolocator():
+
+    def __init__(self, geolocator, rate_limiter):
+        self.geolocator = geolocator
+        self.rate_limiter = rate_limiter
+
+    def geocode(self, *args, **kwargs):
+        self.rate_limiter.acquire()
+        return self.geolocator.geocode(*args, **kwargs)
+
+    def reverse(self, *args, **kwargs):
+        self.rate_limiter.acquire()
+        return self.geolocator.reverse(*args, **kwargs)
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Jul 22 20:51:09 2021
+
+@author: brend
+"""
+
+import pandas as pd
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from datetime import datetime
+
+
+class RefineryRegistry():
+
+    def __init__(self, refineries_file, mycol_refineries = None):
+
+        """
+        Refineries (one row per validity interval in refineries_file) loaded once, rows of each
+        GeoAssetID are indexed to get refineries active at a date among some ids without scanning
+        all refineries
+        Args:
+            * refineries_file (str): CSV file of refineries (GeoAssets_Table)
+            * mycol_refineries (pymongo.Collection): MongoDb collection of refineries, to get
+              country of refineries (optional)
+        """
+
+        self.refineries_df = pd.read_csv(refineries_file)[
+            ["GeoAssetID", "GeoAssetName", "City", "Latitude", "Longitude", "FromDate", "ToDate"]]
+        self.refineries_df["FromDate"] = pd.to_datetime(self.refineries_df["FromDate"])
+        # When FromDate is NaT means from infinite
+        self.refineries_df["FromDate"] = self.refineries_df["FromDate"].fillna(
+            pd.to_datetime("1800-01-01"))
+        # When ToDate is NaT means to today
+        self.refineries_df["ToDate"] = pd.to_datetime(self.refineries_df["ToDate"])
+        self.refineries_df["ToDate"] = self.refineries_df["ToDate"].fillna(
+            pd.to_datetime(datetime.utcnow().date()))
+        self.refineries_df = self.refineries_df.reset_index(drop = True)
+        # Columns of each row (rows in order of refineries_file)
+        self.ids = self.refineries_df["GeoAssetID"].astype(int).tolist()
+        self.from_dates = self.refineries_df["FromDate"].dt.to_pydatetime().tolist()
+        self.to_dates = self.refineries_df["ToDate"].dt.to_pydatetime().tolist()
+        self.latitudes = self.refineries_df["Latitude"].to_numpy()
+        self.longitudes = self.refineries_df["Longitude"].to_numpy()
+        # Distinct FromDates and ToDates sorted, to get validity epoch of dates
+        self.from_dates_sorted = sorted(set(self.from_dates))
+        self.to_dates_sorted = sorted(set(self.to_dates))
+        # Rows of each GeoAssetID
+        self.rows = {}
+        for row, geo_asset_id in enumerate(self.ids):
+            self.rows.setdefault(geo_asset_id, []).append(row)
+        # Name and city of each GeoAssetID
+        self.names = dict(zip(self.ids, self.refineries_df["GeoAssetName"].tolist()))
+        self.cities = dict(zip(self.ids, self.refineries_df["City"].tolist()))
+        # Countries of each GeoAssetID (one per refinery location in collection)
+        self.countries = {}
+        if mycol_refineries is not None:
+            for refinery in mycol_refineries.find({}, {"GeoAssetID": 1, "country": 1, "_id": 0}):
+                self.countries.setdefault(int(refinery["GeoAssetID"]), []).append(
+                    refinery.get("country"))
+
+    # Rows of refineries among ids active at date, in order of refineries_file
+    def active(self, ids, date):
+        return sorted([row for geo_asset_id in set(ids) for row in self.rows.get(geo_asset_id, [])
+                       if self.from_dates[row] <= date and self.to_dates[row] >= date])
+
+    # Validity epoch of date (number of FromDates <= date, number of ToDates < date), refineries
+    # active at dates in same epoch are the same
+    def epoch(self, date):
+        return (bisect_right(self.from_dates_sorted, date), bisect_left(self.to_dates_sorted, date))
+
+    # GeoAssetIDs of rows
+    def get_ids(self, rows):
+        return [self.ids[row] for row in rows]
+
+    # ref_match of rows, all with same confidence
+    def ref_match(self, rows, confidence):
+        return [{"GeoAssetID": self.ids[row], "GeoAssetName": self.names[self.ids[row]],
+                 "confidence": confidence} for row in rows]
+
+    # ref_match of single refinery matched with 100% confidence
+    def perfect_match(self, geo_asset_id):
+        return [{"GeoAssetID": geo_asset_id, "GeoAssetName": self.names[geo_asset_id],
+                 "confidence": 1.0}]
+
+    # country_match of GeoAssetIDs, share of refineries locations in each country
+    def country_match(self, geo_asset_ids):
+        countries = [country for geo_asset_id in sorted(set(geo_asset_ids))
+                     for country in self.countries.get(geo_asset_id, [])]
+        if len(countries) == 0:
+            return []
+        return [{"country": country, "p": round(n / len(countries), 2)}
+                for country, n in Counter(countries).most_common() if country is not None]
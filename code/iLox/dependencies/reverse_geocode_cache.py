@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Jul 23 21:14:36 2021
+
+@author: brend
+"""
+
+import time
+import pymongo
+import warnings
+from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from iLox.dependencies.rate_limiter import RateLimiter, RateLimitedGeolocator
+from iLox.dependencies.chunks import iter_chunks
+
+
+# Reverse geocode coordinates, retry max_attempts times on Nominatim errors
+# Return raw location (dict) or None if all attempts failed
+def query_reverse(geolocator, latitude, longitude, max_attempts = 5, wait_error = 5):
+    # Imported here, geopy only needed when querying Nominatim
+    from geopy.exc import GeocoderUnavailable, GeocoderServiceError
+    for i in range(max_attempts):
+        try:
+            location = geolocator.reverse("%r, %r" % (latitude, longitude), language = "en")
+            return location.raw if location is not None else None
+        # GeocoderTimedOut and GeocoderRateLimited are GeocoderServiceError too
+        except (GeocoderUnavailable, GeocoderServiceError):
+            # Wait longer after each failed attempt
+            time.sleep(wait_error * (i + 1))
+    return None
+
+
+class ReverseGeocodeCache():
+
+    def __init__(self, mycol_cache, geolocator, precision = 5, max_attempts = 5, wait_error = 5,
+                 rate_per_sec = 1.0, burst = 1, max_workers = 4):
+
+        """
+        Reverse geocoding results (address and bounding box) of coordinates, saved in collection
+        by rounded coordinates so refineries at the same location are never queried twice
+        Args:
+            * mycol_cache (pymongo.Collection): MongoDb collection of reverse geocoding results
+            * geolocator (geopy.geocoders.Nominatim): Geolocator used for coordinates not in
+              collection, any object with the same reverse method can be used (e.g. local stub)
+            * precision (int): Decimals kept to round coordinates (5 is about 1 meter)
+            * max_attempts (int): Attempts per reverse query
+            * wait_error (float): Seconds to wait after first error (then 2x, 3x ...)
+            * rate_per_sec (float): Reverse queries per second, shared by all threads
+            * burst (int): Reverse queries allowed at once
+            * max_workers (int): Reverse queries in flight
+        """
+
+        self.mycol_cache = mycol_cache
+        self.geolocator = RateLimitedGeolocator(geolocator, RateLimiter(rate_per_sec, burst))
+        self.precision = precision
+        self.max_attempts = max_attempts
+        self.wait_error = wait_error
+        self.max_workers = max_workers
+        self.n_db = 0
+        self.n_queried = 0
+        self.n_failed = 0
+
+    # Key of coordinates in collection (_id)
+    def _key(self, latitude, longitude):
+        return "%.*f,%.*f" % (self.precision, latitude, self.precision, longitude)
+
+    # Raw locations of coordinates (list of (latitude, longitude)), dict by coordinates
+    # Coordinates not in collection are queried concurrently (rate limited) then saved in bulk
+    # Coordinates with same rounded key share the same location (queried once)
+    # Coordinates failing after all attempts are missing from output
+    def get_many(self, coordinates, display_pb = False):
+        # Coordinates of each key
+        keys = {}
+        for i in set(coordinates):
+            keys.setdefault(self._key(*i), []).append(i)
+        locations = {}
+        found = set()
+        for these_keys in iter_chunks(list(keys.keys()), 10000):
+            for cached in self.mycol_cache.find({"_id": {"$in": these_keys}}):
+                found.add(cached["_id"])
+                for i in keys[cached["_id"]]:
+                    locations[i] = cached["location"]
+        self.n_db += len(found)
+        new_keys = [i for i in keys.keys() if i not in found]
+        if len(new_keys) == 0:
+            return locations
+        new_docs = []
+        with ThreadPoolExecutor(max_workers = self.max_workers) as executor:
+            futures = {executor.submit(query_reverse, self.geolocator, *keys[key][0],
+                                       self.max_attempts, self.wait_error): key
+                       for key in new_keys}
+            for future in tqdm(as_completed(futures), total = len(futures),
+                               disable = display_pb,
+                               desc = "Reverse geocoding refineries",
+                               leave = True):
+                location = future.result()
+                self.n_queried += 1
+                if location is None:
+                    self.n_failed += 1
+                    continue
+                for i in keys[futures[future]]:
+                    locations[i] = location
+                new_docs.append({"_id": futures[future], "location": location})
+        if self.n_failed > 0:
+            warnings.warn("Reverse geocoding failed for %r coordinates" % self.n_failed)
+        # Upserted, coordinates may have been saved meanwhile (e.g. concurrent run)
+        if len(new_docs) > 0:
+            self.mycol_cache.bulk_write(
+                [pymongo.UpdateOne({"_id": i["_id"]}, {"$set": {"location": i["location"]}}, 
+                                   upsert = True) for i in new_docs], ordered = False)
+        return locations
+
+    def stats(self):
+        return "Reverse geocoding: %r from database, %r queried (%r failed)" % (
+            self.n_db, self.n_queried, self.n_failed)
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Jul 15 22:48:35 2021
+
+@author: brend
+"""
+
+import re
+
+
+# Capitalised word, potential location name
+CAPITALISED_TOKEN = re.compile(r"[A-Z][\w\-']+")
+
+# Strategies to combine Spacy models
+# all: every model on every text
+# tiered: every model except last (largest) on every text, last model only on texts where the
+#         smaller models disagree or with capitalised words not covered by entities or known names
+NLP_STRATEGIES = ["all", "tiered"]
+
+# Spacy models already loaded in this process, by name (shared by all stages)
+_ner_models = {}
+
+
+# Load Spacy model with only entity recognizer enabled (other components not needed for GPEs)
+def load_ner_model(model_name):
+    # Imported here, Spacy only needed by matching stages
+    import spacy
+    spacy_model = spacy.load(model_name)
+    spacy_model.select_pipes(enable = [i for i in spacy_model.pipe_names if i == "ner"])
+    return spacy_model
+
+
+# Get Spacy model (only entity recognizer), loaded at most once per process on first use
+def get_ner_model(model_name):
+    if model_name not in _ner_models.keys():
+        print("Loading Spacy model %s ..." % model_name)
+        _ner_models[model_name] = load_ner_model(model_name)
+    return _ner_models[model_name]
+
+
+# Name and version of Spacy model, e.g. en_core_web_sm-3.0.0
+def model_key(spacy_model):
+    return "%s_%s-%s" % (spacy_model.meta.get("lang"), spacy_model.meta.get("name"),
+                         spacy_model.meta.get("version"))
+
+
+# Extract GPEs and NORPs from texts with one model, texts processed in batches with nlp.pipe
+# Return list of (text, label) for each text
+def _run_model(spacy_model, texts, batch_size = 256, n_process = 1):
+    return [[(str(i), i.label_) for i in doc.ents if i.label_ in ["GPE", "NORP"]]
+            for doc in spacy_model.pipe(texts, batch_size = batch_size, n_process = n_process)]
+
+
+# Extract GPEs and NORPs from texts with one model, if nlp_cache (NLPCache) provided only texts
+# not already in cache are processed (once per distinct text)
+def _extract_model(spacy_model, texts, batch_size = 256, n_process = 1, nlp_cache = None):
+    if nlp_cache is None:
+        return _run_model(spacy_model, texts, batch_size, n_process)
+    this_model_key = model_key(spacy_model)
+    keys = [nlp_cache.key(this_model_key, i) for i in texts]
+    spacy_results = nlp_cache.get_many(keys)
+    new_texts = {}
+    for key, text in zip(keys, texts):
+        if key not in spacy_results.keys():
+            new_texts[key] = text
+    new_results = dict(zip(new_texts.keys(), _run_model(
+        spacy_model, list(new_texts.values()), batch_size, n_process)))
+    nlp_cache.put_many(new_results)
+    spacy_results.update(new_results)
+    return [list(spacy_results[key]) for key in keys]
+
+
+# Capitalised words of text not part of any of names (words starting a sentence or a
+# mention are ignored)
+def _uncovered_tokens(text, names):
+    covered = " ".join(names).lower()
+    tokens = []
+    for token in CAPITALISED_TOKEN.finditer(text):
+        # Inside a word or a mention
+        if token.start() > 0 and (text[token.start() - 1].isalnum() or
+                                  text[token.start() - 1] in "@_"):
+            continue
+        # Start of sentence
+        before = text[max(0, token.start() - 20):token.start()].rstrip(" \t")
+        if len(before) == 0 or before[-1] in ".!?:\n":
+            continue
+        if token.group(0).lower() not in covered:
+            tokens.append(token.group(0))
+    return tokens
+
+
+# Whether largest model is needed for text in tiered strategy
+def _needs_last_model(text, models_results, known_names):
+    # Smaller models disagree
+    if len(set([frozenset([i[0] for i in r]) for r in models_results])) > 1:
+        return True
+    # Capitalised words not covered by entities found or known names
+    names = [i[0] for r in models_results for i in r] + list(known_names)
+    return len(_uncovered_tokens(text, names)) > 0
+
+
+# Extract GPEs and NORPs from texts with Spacy models according to strategy
+# known_names: names already known for each text (e.g. from gazetteers), used by tiered strategy
+# Return list of (text, label) for each text
+def extract_entities(spacy_models, texts, batch_size = 256, n_process = 1, nlp_cache = None,
+                     strategy = "all", known_names = None):
+    if strategy not in NLP_STRATEGIES:
+        raise ValueError("Unknown NLP strategy %r, must be one of %r" % (strategy, NLP_STRATEGIES))
+    if strategy == "tiered" and len(spacy_models) > 1:
+        first_models = spacy_models[:-1]
+        last_model = spacy_models[-1]
+    else:
+        first_models = spacy_models
+        last_model = None
+    models_results = [_extract_model(spacy_model, texts, batch_size, n_process, nlp_cache)
+                      for spacy_model in first_models]
+    spacy_results = [[i for r in models_results for i in r[index]] for index in range(len(texts))]
+    if last_model is not None:
+        if known_names is None:
+            known_names = [[] for i in texts]
+        last_indexes = [index for index in range(len(texts)) if _needs_last_model(
+            texts[index], [r[index] for r in models_results], known_names[index])]
+        last_results = _extract_model(
+            last_model, [texts[i] for i in last_indexes], batch_size, n_process, nlp_cache)
+        for index, this_results in zip(last_indexes, last_results):
+            spacy_results[index].extend(this_results)
+    return spacy_results
+
+
+# Convert (text, label) extracted with Spacy to list of unique locations names
+def clean_entities(spacy_results, norps_gpes, remove_urls = False):
+    # Remove "http" (sometimes matched as GPE) and punctuation
+    if remove_urls:
+        spacy_results = [
+            (" ".join([re.sub(r'[^\w\s]', '', i).strip() for i in text.split(" ")
+                       if "http" not in i]).strip(), label) for text, label in spacy_results]
+        spacy_results = [i for i in spacy_results if len(i[0]) > 0]
+    # List of texts flagged both as GPEs and NORPs, keep only GPEs
+    flag_both = set([text for text, label in spacy_results if label == "GPE"]).intersection(
+        [text for text, label in spacy_results if label == "NORP"])
+    spacy_results = [(text, label) for text, label in spacy_results
+                     if not (text in flag_both and label == "NORP")]
+    # Convert NORPs to GPEs
+    return list(set([norps_gpes[text] if label == "NORP" and text in norps_gpes.keys()
+                     else text for text, label in spacy_results]))
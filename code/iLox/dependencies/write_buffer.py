@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Jul 11 15:40:18 2021
+
+@author: brend
+"""
+
+from pymongo import UpdateOne
+
+
+class WriteBuffer():
+
+    def __init__(self, mycol, batch_size = 1000, default_fields = None):
+
+        """
+        Accumulate fields updates per document and write them in bulk
+        Args:
+            * mycol (pymongo.Collection): MongoDb collection to update
+            * batch_size (int): Number of documents updated per bulk_write
+            * default_fields (dict): Fields set on every document updated (e.g. match_stage)
+        """
+
+        self.mycol = mycol
+        self.batch_size = batch_size
+        self.default_fields = default_fields if default_fields is not None else {}
+        self.updates = {}
+        self.n_updates = 0
+        self.n_flushes = 0
+
+    # Set fields (dict) of document, overwrite previous value of same fields not flushed yet
+    def set(self, _id, fields):
+        if _id in self.updates.keys():
+            self.updates[_id].update(fields)
+        else:
+            self.updates[_id] = {**self.default_fields, **fields}
+        if len(self.updates) >= self.batch_size:
+            self.flush()
+
+    # Send one $set per document, unordered
+    def flush(self):
+        if len(self.updates) == 0:
+            return
+        requests = [UpdateOne({"_id": _id}, {"$set": fields})
+                    for _id, fields in self.updates.items()]
+        self.mycol.bulk_write(requests, ordered = False)
+        self.n_updates += len(requests)
+        self.n_flushes += 1
+        self.updates = {}
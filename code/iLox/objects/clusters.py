@@ -10,7 +10,15 @@ import pandas as pd
 import numpy as np
 from functools import reduce
 from tqdm import tqdm
-from datetime import datetime
+
+
+# Country of country_match with highest probability (last one if several)
+def _top_country(country_match):
+    top = country_match[0]
+    for this_match in country_match[1:]:
+        if this_match["p"] >= top["p"]:
+            top = this_match
+    return top["country"]
 
 
 class RefEventsClusters():
@@ -75,47 +83,43 @@ class RefEventsClusters():
         return this_df.iloc[cluster]["_id"].tolist()
     
     # Prepare data for time and events clustering for all countries
+    # Items streamed from MongoDb, only fields used by clustering kept in memory
     def _prepare_clustering_data(self):
+        read_batch_size = self.ref_match_params["global"]["read_batch_size"]
+        query = {"country_match.p": {"$gt": 0.5}}
+        n_items = self.mycol_merged.count_documents(query)
         # Time-based
-        # Import headline information from mongodb. Change it into a list.
-        self.data_headline_t = list(self.mycol_merged.find(
-            {"country_match.p": {"$gt": 0.5}}, 
-            {"country_match": 1, "created_at": 1, "text": 1}))
-        for headline in tqdm(self.data_headline_t, 
-                             disable = self.ilox_logger.display_pb(), 
-                             desc = "Preparing time clustering data", 
-                             leave = True):
-            # Only keep country_match with highest probability
-            headline["country"] = pd.DataFrame(
-                headline.pop("country_match")).sort_values("p").iloc[-1]["country"]
-            # Change time to timestamp
-            headline["time"] = datetime.strptime(
-                headline.pop("created_at"), "%Y-%m-%dT%H:%M:%S.%fZ").timestamp()
-        self.data_headline_t = pd.DataFrame(self.data_headline_t)
+        self.data_headline_t = []
+        with self.mycol_merged.find(query, {"country_match": 1, "created_at": 1}, 
+                                    batch_size = read_batch_size) as cursor:
+            for headline in tqdm(cursor, total = n_items, 
+                                 disable = self.ilox_logger.display_pb(), 
+                                 desc = "Preparing time clustering data", 
+                                 leave = True):
+                self.data_headline_t.append({
+                    "_id": headline["_id"], 
+                    # Only keep country_match with highest probability
+                    "country": _top_country(headline["country_match"]), 
+                    "time": headline["created_at"]})
+        self.data_headline_t = pd.DataFrame(self.data_headline_t, columns = ["_id", "country", "time"])
+        # Change time to timestamp (seconds), dates from MongoDb converted at once
+        self.data_headline_t["time"] = (
+            pd.to_datetime(self.data_headline_t["time"]) - pd.Timestamp(0)).dt.total_seconds()
         # Events-based
         self.events_types = self.mycol_merged.distinct("events_tags")
-        # Get events and country for each headline
-        self.data_headline_e = list(self.mycol_merged.find(
-            {"country_match.p": {"$gt": 0.5}}, 
-            {"country_match": 1, "events_tags": 1}))
-        for headline in tqdm(self.data_headline_e, 
-                             disable = self.ilox_logger.display_pb(), 
-                             desc = "Preparing events clustering data", 
-                             leave = True):
-            # Only keep country_match with highest probability
-            headline["country"] = pd.DataFrame(
-                headline.pop("country_match")).sort_values("p").iloc[-1]["country"]
-            # Change events_tags to 1 or 0 for each event type
-            events_tags = headline.pop("events_tags")
-            for event_type in self.events_types:
-                headline[event_type] = min(events_tags.count(event_type), 1)
-        # Group by country
-        countries_list = pd.DataFrame(
-            self.data_headline_e)["country"].unique().tolist()
-        self.data_headline_e = {
-            country: {i.pop("_id"): dict((k, v) for k,v in i.items() if k != "country") 
-                      for i in self.data_headline_e if i["country"] == country} 
-            for country in countries_list}
+        # Get events of each headline, grouped by country
+        self.data_headline_e = {}
+        with self.mycol_merged.find(query, {"country_match": 1, "events_tags": 1}, 
+                                    batch_size = read_batch_size) as cursor:
+            for headline in tqdm(cursor, total = n_items, 
+                                 disable = self.ilox_logger.display_pb(), 
+                                 desc = "Preparing events clustering data", 
+                                 leave = True):
+                # Change events_tags to 1 or 0 for each event type
+                self.data_headline_e.setdefault(
+                    _top_country(headline["country_match"]), {})[headline["_id"]] = {
+                        event_type: min(headline["events_tags"].count(event_type), 1) 
+                        for event_type in self.events_types}
         
     # Perform clustering on time/country
     def _time_based_clustering(self, country):
@@ -296,9 +300,7 @@ class RefEventsClusters():
                         self._get_items_ids_cluster(this_df, [i])[0] for i in cluster if 
                         self._get_asset_ids_cluster(this_df, [i])[0] in these_matchs]
                     # Get ref_match of perfect match
-                    ref_match = self.mycol_merged.find_one(
-                        {"_id": {"$in": these_items}, "ref_match": {"$size": 1}}, 
-                        {"ref_match": 1})["ref_match"]
+                    ref_match = self.get_refinery_registry().perfect_match(single_match)
                     # If events_subsplit, split based on events distance
                     if self.events_subsplit and len(these_items) >= self.events_subsplit_min_size:
                         subclusters_list, data_ids = self._split_cluster_events(
@@ -10,7 +10,9 @@ import pymongo
 import pandas as pd
 import numpy as np
 import re
+import time
 from tqdm import tqdm
+from iLox.dependencies.gazetteer_matcher import get_gazetteer_matcher
 
 
 class DataPrep():
@@ -25,6 +27,7 @@ class DataPrep():
         self.geo_names_refineries = self.data_prep_params["geo_names_refineries"]
         self.geo_names_cities = self.data_prep_params["geo_names_cities"]
         self.ref_owners_names = self.data_prep_params["ref_owners_names"]
+        self.gazetteer_dir = self.data_prep_params["gazetteer_dir"]
         
     def _set_parent_attrs(self):
         attributes = [attr for attr in dir(self) if not attr.startswith("_")]
@@ -41,29 +44,36 @@ class DataPrep():
         self._get_geo_names_cities()
         # Get list of potential owners names
         self._get_owners_names()
+        # Compile gazetteer from names files
+        self._get_gazetteer_matcher()
         # Set parent attributes
         self._set_parent_attrs()
         
     # Load previously generated output of data preparation process
     def _read(self):
-        if os.path.exists(self.geo_names_refineries):
-            self.geo_names_r = pd.read_csv(self.geo_names_refineries).to_dict(orient = "records")
-        else:
+        if not os.path.exists(self.geo_names_refineries):
             print("geo_names_refineries file not found, running corresponding DataPrep level")
             self._get_geo_names_refineries()
-        if os.path.exists(self.geo_names_cities):
-            self.cities_names = pd.read_csv(self.geo_names_cities).to_dict(orient = "records")
-        else:
+        if not os.path.exists(self.geo_names_cities):
             print("geo_names_cities file not found, running corresponding DataPrep level")
             self._get_geo_names_cities()
-        if os.path.exists(self.ref_owners_names):
-            self.owners_names = pd.read_csv(self.ref_owners_names).to_dict(orient = "records")
-        else:
+        if not os.path.exists(self.ref_owners_names):
             print("ref_owners_names file not found, running corresponding DataPrep level")
-            self._get_geo_names_cities()
+            self._get_owners_names()
+        # Compiled gazetteer, rebuilt only if names files changed
+        self._get_gazetteer_matcher()
         # Set parent attributes
         self._set_parent_attrs()
             
+    # Get matcher of refineries, cities and owners names from compiled gazetteer
+    def _get_gazetteer_matcher(self):
+        start = time.perf_counter()
+        self.gazetteer_matcher = get_gazetteer_matcher(
+            [self.geo_names_refineries, self.geo_names_cities, self.ref_owners_names], 
+            self.gazetteer_dir)
+        print("Gazetteer: %r names in %.2f s" % (
+            len(self.gazetteer_matcher.entries), time.perf_counter() - start))
+            
     # Prepare refineries data - Get geo data from Nominatim
     def _prep_ref_data(self):
         ref_data = pd.read_csv(self.refineries_file)
@@ -73,15 +83,20 @@ class DataPrep():
         process_ids = list(set(ref_data["GeoAssetID"].tolist()).difference(self.mycol_refineries.distinct("GeoAssetID")))
         process_ids.extend(self.data_prep_params["update_refs"])
         process_ids = list(set(process_ids))
-        coord_items = []
-        for item in tqdm(coord_df[coord_df["GeoAssetID"].isin(process_ids)].to_dict(orient = "index").values(), 
-                         disable = self.ilox_logger.display_pb(), 
-                         desc = "Updating Refineries collection", 
-                         leave = True):
-            location = self.geolocator.reverse("%r, %r" % (item["Latitude"], item["Longitude"]), language = "en")
-            item = {**item, **location.raw["address"]}
-            item["bounding_box"] = [float(i) for i in location.raw["boundingbox"]]
-            coord_items.append(item)
+        coord_items = coord_df[coord_df["GeoAssetID"].isin(process_ids)].to_dict(orient = "records")
+        # Reverse geocoding from cache by rounded coordinates, others queried concurrently
+        reverse_geocode_cache = self.get_reverse_geocode_cache()
+        locations = reverse_geocode_cache.get_many(
+            [(i["Latitude"], i["Longitude"]) for i in coord_items], 
+            self.ilox_logger.display_pb())
+        print(reverse_geocode_cache.stats())
+        # Refineries failing reverse geocoding not saved, processed again on next run
+        coord_items = [item for item in coord_items 
+                       if (item["Latitude"], item["Longitude"]) in locations.keys()]
+        for item in coord_items:
+            location = locations[(item["Latitude"], item["Longitude"])]
+            item.update(location["address"])
+            item["bounding_box"] = [float(i) for i in location["boundingbox"]]
         # Set fields missing for some items to NaN
         coord_items = pd.DataFrame(coord_items).to_dict(orient = "records")
         self._refineries_to_mongo(coord_items)
@@ -97,7 +112,15 @@ class DataPrep():
                                                            [coord_item["bounding_box"][2], coord_item["bounding_box"][0]],
                                                            [coord_item["bounding_box"][2], coord_item["bounding_box"][1]]]], 
                                           "type": "Polygon"}
-            self.mycol_refineries.insert_one(coord_item)
+        # Upsert refineries by GeoAssetID and coordinates in bulk, then delete previous coordinates
+        # of refineries processed again (update_refs), refineries kept if writing fails
+        if len(coord_items) > 0:
+            self.mycol_refineries.bulk_write(
+                [pymongo.ReplaceOne({"GeoAssetID": i["GeoAssetID"], "point": i["point"]}, i, 
+                                    upsert = True) for i in coord_items], ordered = False)
+            self.mycol_refineries.delete_many(
+                {"GeoAssetID": {"$in": list(set([i["GeoAssetID"] for i in coord_items]))}, 
+                 "$nor": [{"GeoAssetID": i["GeoAssetID"], "point": i["point"]} for i in coord_items]})
         # Create indexes if not already exists
         existing_idx = self.mycol_refineries.index_information()
         if "point_2dsphere" not in existing_idx.keys():
@@ -109,6 +132,7 @@ class DataPrep():
         
     # Get list of potential refineries names
     def _get_geo_names_refineries(self):
+        start = time.perf_counter()
         names = pd.read_csv(
             self.refineries_file)[["GeoAssetID", "GeoAssetName"]].drop_duplicates(subset = ["GeoAssetName"])
         geo_names_r_original = names.to_dict(orient = "records")
@@ -132,23 +156,29 @@ class DataPrep():
             if len(words) <= 3:
                 geo_names_r.append({"id": name_id, "initial": geo_name_orig, "match": "".join(words[:3]), "type": "refname"})
                 geo_names_r.append({"id": name_id, "initial": geo_name_orig, "match": "".join(words[:2]), "type": "refname"})
-            # Convert geo_names_r to dataframe to drop duplicates
-            geo_names_r_df = pd.DataFrame(geo_names_r).drop_duplicates(subset = ["initial", "match"])
-            # Keep only not empty names
-            geo_names_r_df = geo_names_r_df[geo_names_r_df["match"] != ""]
-            # Save as CSV file to avoid rerun
-            geo_names_r_df.to_csv(self.geo_names_refineries, index = False)
-            # Return as list
-            self.geo_names_r = geo_names_r_df.to_dict(orient = "records")
-            # Update MongoDb collection
-            self.mycol_refineries.update_many({}, {"$set": {"refnames": []}})
-            for geo_name in self.geo_names_r:
-                self.mycol_refineries.update_one(
-                    {"GeoAssetID": geo_name["id"]}, 
-                    {"$push": {"refnames": geo_name["match"]}})
+        # Convert geo_names_r to dataframe to drop duplicates
+        geo_names_r_df = pd.DataFrame(geo_names_r).drop_duplicates(subset = ["initial", "match"])
+        # Keep only not empty names
+        geo_names_r_df = geo_names_r_df[geo_names_r_df["match"] != ""]
+        # Save as CSV file to avoid rerun
+        geo_names_r_df.to_csv(self.geo_names_refineries, index = False)
+        # Return as list
+        self.geo_names_r = geo_names_r_df.to_dict(orient = "records")
+        # Update MongoDb collection, all refnames of each GeoAssetID set at once
+        refnames = {int(k): v for k, v in 
+                    geo_names_r_df.groupby("id", sort = False)["match"].apply(list).items()}
+        self.mycol_refineries.update_many(
+            {"GeoAssetID": {"$nin": list(refnames.keys())}}, {"$set": {"refnames": []}})
+        if len(refnames) > 0:
+            self.mycol_refineries.bulk_write(
+                [pymongo.UpdateMany({"GeoAssetID": geo_asset_id}, {"$set": {"refnames": names}}) 
+                 for geo_asset_id, names in refnames.items()], ordered = False)
+        print("Refineries names: %r names in %.2f s" % (
+            len(self.geo_names_r), time.perf_counter() - start))
                 
     # Get list of potential cities names
     def _get_geo_names_cities(self):
+        start = time.perf_counter()
         cities = pd.read_csv(
             self.refineries_file)[["GeoAssetID", "City"]].drop_duplicates().dropna()
         cities_names_original = cities.to_dict(orient = "records")
@@ -189,11 +219,14 @@ class DataPrep():
         cities_names_df.to_csv(self.geo_names_cities, index = False)
         # Return as list
         self.cities_names = cities_names_df.to_dict(orient = "records")
+        print("Cities names: %r names in %.2f s" % (
+            len(self.cities_names), time.perf_counter() - start))
         
     # Get list of potential owners names
     def _get_owners_names(self):
+        start = time.perf_counter()
         names = pd.read_csv(self.owners_file)[["GeoAssetID", "CompanyName"]].drop_duplicates()
-        names = names.replace("Unknown", np.NaN).dropna().to_dict(orient = "records")
+        names = names.replace("Unknown", np.nan).dropna().to_dict(orient = "records")
         owners_names = []
         for owner_name in tqdm(names, disable = self.ilox_logger.display_pb(), 
                                desc = "Creating owners names", 
@@ -221,4 +254,6 @@ class DataPrep():
         # Save as CSV file to avoid rerun
         owners_names_df.to_csv(self.ref_owners_names, index = False)
         # Return as list
-        self.owners_names = owners_names_df.to_dict(orient = "records")
\ No newline at end of file
+        self.owners_names = owners_names_df.to_dict(orient = "records")
+        print("Owners names: %r names in %.2f s" % (
+            len(self.owners_names), time.perf_counter() - start))
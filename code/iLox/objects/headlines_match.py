@@ -7,12 +7,20 @@ Created on Fri Jun  4 17:32:07 2021
 
 import sys
 import os
-import spacy
 import pymongo
 import pandas as pd
 from tqdm import tqdm
-from datetime import datetime
 from iLox.dependencies.get_match import get_match_proba
+from iLox.dependencies.gazetteer_matcher import clean_owner_tags
+from iLox.dependencies.write_buffer import WriteBuffer
+from iLox.dependencies.spacy_ner import get_ner_model, extract_entities, clean_entities
+from iLox.dependencies.chunks import iter_chunks
+from iLox.dependencies.nlp_cache import NLPCache
+from iLox.dependencies.match_state import (
+    inputs_fingerprint, pending_filter, complete_stage, STAGE_RESET, STAGE_NAMES, STAGE_NLP, 
+    STAGE_REFINERIES, STAGE_COUNTRIES, STAGE_EVENTS, with_derived_fields, prep_derived_fields)
+from iLox.dependencies.query_plan import check_query_plan
+from iLox.dependencies.item_dates import to_datetime, prep_dates
 
 
 class HeadlinesMatch():
@@ -22,16 +30,19 @@ class HeadlinesMatch():
         for attribute in attributes:
             setattr(self, attribute, getattr(parent, attribute))
         self._parent = parent
-        # Load Spacy models
-        self.spacy_models = [spacy.load(model) for model in self.ref_match_params["headlines_matching"]["nlp_models"]]
         if self.ref_match_params["headlines_matching"]["start"] is not None:
-            self.headlines_start = self.ref_match_params["headlines_matching"]["start"]
+            self.headlines_start = to_datetime(self.ref_match_params["headlines_matching"]["start"])
         else:
-            self.headlines_start = "1900-01-01"
+            self.headlines_start = to_datetime("1900-01-01")
         if self.events_match_params["start"] is not None:
-            self.events_start = self.events_match_params["start"]
+            self.events_start = to_datetime(self.events_match_params["start"])
         else:
-            self.events_start = "1900-01-01"
+            self.events_start = to_datetime("1900-01-01")
+        self.write_batch_size = self.ref_match_params["global"]["write_batch_size"]
+        self.read_batch_size = self.ref_match_params["global"]["read_batch_size"]
+        self.incremental = self.ref_match_params["global"]["incremental"]
+        self.check_query_plans = self.ref_match_params["global"]["check_query_plans"]
+        self.strict_query_plans = self.ref_match_params["global"]["strict_query_plans"]
         
     def _get_parent_attrs(self):
         attributes = [attr for attr in dir(self._parent) if not attr.startswith("_")]
@@ -42,17 +53,15 @@ class HeadlinesMatch():
     def _run(self):
         # Get parent attributes
         self._get_parent_attrs()
+        # Fingerprint of matching inputs
+        self._get_match_fingerprint()
         # Prepare MongoDb col, remove old matchs
         print("Preparing MongoDb collection ...")
         self._prep_col()
-        # Match headlines with refineries names
-        self._geotag_headlines_refineries()
-        # Match headlines with cities names
-        self._geotag_headlines_cities()
+        # Match headlines with refineries, cities and owners names
+        self._geotag_headlines_gazetteers()
         # Use Spacy to extract other locations (GPEs)
         self._geotag_headlines()
-        # Match headlines with owners names
-        self._match_headlines_owners()
         # Get probabilities of match for refineries
         self._match_headlines()
         # Match to country/countries based on ref_match
@@ -61,6 +70,19 @@ class HeadlinesMatch():
             # Extract event types from headlines
             self._match_headlines_event_type()
         
+    # Fingerprint of files and parameters used to match, headlines matched with other inputs 
+    # are matched again in incremental mode
+    def _get_match_fingerprint(self):
+        self.match_fingerprint = inputs_fingerprint(
+            [self.data_prep_params["geo_names_refineries"], 
+             self.data_prep_params["geo_names_cities"], 
+             self.data_prep_params["ref_owners_names"], 
+             self.data_prep_params["refineries_file"], 
+             self.ref_match_params["global"]["norps_gpes_file"]], 
+            self.ref_match_params["headlines_matching"]["nlp_models"], 
+            self.ref_match_params["headlines_matching"]["nlp_strategy"], 
+            self.tweets_scraping_params["events_keywords_text"])
+        
     # Prepare MongoDb collection (add geo_tags keys and clean up previous matches)
     def _prep_col(self):
         # Create indexes if not already exist
@@ -76,107 +98,55 @@ class HeadlinesMatch():
                 [("text", pymongo.TEXT), ("snippet", pymongo.TEXT)], 
                 name = "text_snippet_text", unique = False, 
                 default_language = "en", language_override = "en")
+        if "match_fingerprint_match_stage" not in existing_idx.keys():
+            self.mycol_headlines.create_index(
+                [("match_fingerprint", pymongo.ASCENDING), ("match_stage", pymongo.ASCENDING)], 
+                name = "match_fingerprint_match_stage", unique = False)
+        # Indexes on derived fields (has_geo_tags, n_ref_match, has_events ...)
+        prep_derived_fields(self.mycol_headlines, "firstCreated")
+        # Dates stored as dates (headlines inserted with string dates converted)
+        prep_dates(self.mycol_headlines, "firstCreated")
+        # Clean up previous matches, in incremental mode only for new headlines or headlines 
+        # matched with other inputs (others resume from last stage completed)
+        reset_query = {"firstCreated": {"$gte": self.headlines_start}}
+        if self.incremental:
+            reset_query["match_fingerprint"] = {"$ne": self.match_fingerprint}
         self.mycol_headlines.update_many(
-            {"firstCreated": {"$gte": self.headlines_start}}, 
-            {"$set": {"geo_tags": []}})
-        self.mycol_headlines.update_many(
-            {"firstCreated": {"$gte": self.headlines_start}}, 
-            {"$set": {"owner_tags": []}})
-        self.mycol_headlines.update_many(
-            {"firstCreated": {"$gte": self.headlines_start}}, 
-            {"$set": {"ref_match": []}})
-        self.mycol_headlines.update_many(
-            {"firstCreated": {"$gte": self.headlines_start}}, 
-            {"$set": {"country_match": []}})
-        self.mycol_headlines.update_many(
-            {"firstCreated": {"$gte": self.headlines_start}}, 
-            {"$set": {"events_tags": []}})
+            reset_query, 
+            {"$set": with_derived_fields(
+                {"geo_tags": [], "owner_tags": [], "ref_match": [], "country_match": [], 
+                 "events_tags": [], "match_fingerprint": self.match_fingerprint, 
+                 "match_stage": STAGE_RESET})})
             
-    # Geotag headlines from refineries names
-    def _geotag_headlines_refineries(self):
-        for geo_name in tqdm(self.geo_names_r, 
-                             disable = self.ilox_logger.display_pb(), 
-                             desc = "Matching headlines with refineries names", 
-                             leave = True):
-            # Get ids of headlines containing current geoname in text
-            these_ids = [i["_id"] for i in self.mycol_headlines.find(
-                {"firstCreated": {"$gte": self.headlines_start}, 
-                "text": {"$regex": "\\b" + geo_name["match"] + "\\b", "$options": "i"}}, 
-                {"_id": 1})]
-            # Also get ids of headlines containing current geoname in snippet
-            these_ids = [i["_id"] for i in self.mycol_headlines.find(
-                {"firstCreated": {"$gte": self.headlines_start}, 
-                "snippet": {"$regex": "\\b" + geo_name["match"] + "\\b", "$options": "i"}}, 
-                {"_id": 1})]
-            # Also perform text match using index (accents insensitive, include text + snippet)
-            these_ids.extend([i["_id"] for i in self.mycol_headlines.find(
-                {"firstCreated": {"$gte": self.headlines_start}, 
-                "$text": {"$search": "\"" + geo_name["match"] + "\""}}, 
-                {"_id": 1})])
-            # Add current geo_name to matching headline's geo_tags field
-            if len(these_ids) > 0:
-                self.mycol_headlines.update_many(
-                    {"_id": {"$in": list(set(these_ids))}}, {"$push": {"geo_tags": geo_name}})
-            
-    # Geotag headlines from cities names
-    def _geotag_headlines_cities(self):
-        for geo_name in tqdm(self.cities_names, 
-                             disable = self.ilox_logger.display_pb(), 
-                             desc = "Matching headlines with cities names", 
-                             leave = True):
-            # Get ids of headlines containing current geoname
-            # Only look for whole word if len of geo_name is less than 8 (e.g. to get RichmondCA)
-            if len(geo_name) < 8:
-                these_ids = [i["_id"] for i in self.mycol_headlines.find(
-                    {"firstCreated": {"$gte": self.headlines_start}, 
-                     "text": {"$regex": "\\b" + geo_name["match"] + "\\b", "$options": "i"}}, 
-                    {"_id": 1})]
-                these_ids.extend([i["_id"] for i in self.mycol_headlines.find(
-                    {"firstCreated": {"$gte": self.headlines_start}, 
-                     "snippet": {"$regex": "\\b" + geo_name["match"] + "\\b", "$options": "i"}}, 
-                    {"_id": 1})])
-            else:
-                these_ids = [i["_id"] for i in self.mycol_headlines.find(
-                    {"firstCreated": {"$gte": self.headlines_start}, 
-                     "text": {"$regex": geo_name["match"], "$options": "i"}}, 
-                    {"_id": 1})]
-                these_ids.extend([i["_id"] for i in self.mycol_headlines.find(
-                    {"firstCreated": {"$gte": self.headlines_start}, 
-                     "snippet": {"$regex": geo_name["match"], "$options": "i"}}, 
-                    {"_id": 1})])
-            # Also perform text match using index (accents insensitive)
-            these_ids.extend([i["_id"] for i in self.mycol_headlines.find(
-                {"firstCreated": {"$gte": self.headlines_start}, 
-                 "$text": {"$search": "\"" + geo_name["match"] + "\""}}, 
-                {"_id": 1})])
-            # Add current geo_name to matching headline's geo_tags field
-            if len(these_ids) > 0:
-                self.mycol_headlines.update_many(
-                    {"_id": {"$in": list(set(these_ids))}}, 
-                    {"$push": {"geo_tags": geo_name}})
+    # Geotag headlines from refineries and cities names, match headlines with owners names
+    # Single pass over headlines (text + snippet), all names matched at once
+    def _geotag_headlines_gazetteers(self):
+        matcher = self.gazetteer_matcher
+        write_buffer = WriteBuffer(
+            self.mycol_headlines, self.write_batch_size, {"match_stage": STAGE_NAMES})
+        query = {"firstCreated": {"$gte": self.headlines_start}, 
+                 **pending_filter(self.match_fingerprint, STAGE_NAMES)}
+        # Headlines streamed from MongoDb, matchs written by batches as they come
+        with self.mycol_headlines.find(query, {"text": 1, "snippet": 1}, 
+                                       batch_size = self.read_batch_size) as all_headlines:
+            for this_headline in tqdm(all_headlines, 
+                                      total = self.mycol_headlines.count_documents(query), 
+                                      disable = self.ilox_logger.display_pb(), 
+                                      desc = "Matching headlines with refineries, cities and owners names", 
+                                      leave = True):
+                found = matcher.match(this_headline.get("text"))
+                # For total, search case sensitive for TOTAL in snippet
+                found.update(matcher.match(this_headline.get("snippet"), case_sensitive_upper = True))
+                geo_tags, owner_tags = matcher.tags(found)
+                owner_tags = clean_owner_tags(owner_tags)
+                # Add names found to headline's geo_tags and owner_tags fields
+                if len(geo_tags) > 0 or len(owner_tags) > 0:
+                    write_buffer.set(
+                        this_headline["_id"], 
+                        with_derived_fields({"geo_tags": geo_tags, "owner_tags": owner_tags}))
+        write_buffer.flush()
+        complete_stage(self.mycol_headlines, query, STAGE_NAMES)
                 
-    # Extract GPEs and NORPs using Spacy
-    def _extract_spacy(self, text, snippet = None):
-        spacy_results = []
-        for spacy_model in self.spacy_models:
-            [spacy_results.append((str(i), i.label_)) for i in spacy_model(
-                text.replace("#", "")).ents if i.label_ in ["GPE", "NORP"]]
-            if snippet is not None:
-                [spacy_results.append((str(i), i.label_)) for i in spacy_model(
-                    snippet.replace("#", "")).ents if i.label_ in ["GPE", "NORP"]]
-        spacy_results = pd.DataFrame(spacy_results, columns = ["text", "label"])
-        # List of texts flagged both as GPEs and NORPs, keep only GPEs
-        flag_both = [i for i in spacy_results["text"].unique() if len(
-            spacy_results[spacy_results["text"] == i].drop_duplicates()) > 1]
-        spacy_results.drop(
-            spacy_results[(spacy_results["text"].isin(flag_both)) & 
-                          (spacy_results["label"] == "NORP")].index, 
-            inplace = True)
-        spacy_results["text"] = spacy_results.apply(
-            lambda x: self.norps_gpes[x["text"]] if x["text"] in self.norps_gpes.keys() 
-            and x["label"] == "NORP" else x["text"], axis = 1)
-        return list(set(spacy_results["text"].tolist()))
-            
     # Look for location names in headlines
     def _geotag_headlines(self):
         # Read NORPs to GPEs conversion file if not set already
@@ -188,152 +158,142 @@ class HeadlinesMatch():
             else:
                 print("norps_gpes_file file not found, aborting")
                 sys.exit()
-        all_headlines = [i for i in self.mycol_headlines.find(
-            {"firstCreated": {"$gte": self.headlines_start}}, 
-            {"text": 1, "snippet": 1})]
-        for this_headline in tqdm(all_headlines, 
-                                  disable = self.ilox_logger.display_pb(), 
-                                  desc = "Extracing locations using NLP", 
-                                  leave = True):
-            # Use spacy on headline's text and snippet (replacing hashtags)
-            these_locations = self._extract_spacy(this_headline["text"], 
-                                                  snippet = this_headline["snippet"])
-            these_locations = [{"id": None, "initial": i, "match": i, "type": "GPE"} 
-                               for i in these_locations]
-            for this_location in these_locations:
-                self.mycol_headlines.update_one(
-                    {"_id": this_headline["_id"]}, 
-                    {"$push": {"geo_tags": this_location}})
+        write_buffer = WriteBuffer(
+            self.mycol_headlines, self.write_batch_size, {"match_stage": STAGE_NLP})
+        query = {"firstCreated": {"$gte": self.headlines_start}, 
+                 **pending_filter(self.match_fingerprint, STAGE_NLP)}
+        # Headlines processed by chunks, texts of each chunk sent to Spacy in batches
+        nlp_batch_size = self.ref_match_params["headlines_matching"]["nlp_batch_size"]
+        nlp_n_process = self.ref_match_params["headlines_matching"]["nlp_n_process"]
+        # Entities of texts already processed are read from cache
+        nlp_cache = NLPCache(self.mycol_nlp_cache, 
+                             self.ref_match_params["global"]["nlp_cache_max_entries"])
+        nlp_strategy = self.ref_match_params["headlines_matching"]["nlp_strategy"]
+        # Headlines streamed from MongoDb (cursor kept open while Spacy processes chunks)
+        with self.mycol_headlines.find(
+                query, {"text": 1, "snippet": 1, "geo_tags": 1, "owner_tags": 1}, 
+                batch_size = self.read_batch_size, no_cursor_timeout = True) as all_headlines, \
+             tqdm(total = self.mycol_headlines.count_documents(query), 
+                  disable = self.ilox_logger.display_pb(), 
+                  desc = "Extracing locations using NLP", 
+                  leave = True) as pb:
+            for these_headlines in iter_chunks(all_headlines, nlp_batch_size * nlp_n_process * 20):
+                # Headline's text and snippet (replacing hashtags), with index of headline in chunk
+                texts = []
+                texts_sources = []
+                for index, this_headline in enumerate(these_headlines):
+                    for this_text in [this_headline["text"], this_headline["snippet"]]:
+                        if this_text is not None:
+                            texts.append(this_text.replace("#", ""))
+                            texts_sources.append(index)
+                # Names already found in headlines (used by tiered strategy)
+                known_names = [[i2 for i in these_headlines[index].get("geo_tags", []) + 
+                                these_headlines[index].get("owner_tags", []) 
+                                for i2 in [str(i["initial"]), str(i["match"])]] 
+                               for index in texts_sources]
+                # Spacy models loaded on first use only, shared with other matchers
+                spacy_models = [get_ner_model(model) for model in 
+                                self.ref_match_params["headlines_matching"]["nlp_models"]]
+                entities = extract_entities(
+                    spacy_models, texts, nlp_batch_size, nlp_n_process, nlp_cache, 
+                    nlp_strategy, known_names)
+                these_entities = [[] for i in these_headlines]
+                for index, this_entities in zip(texts_sources, entities):
+                    these_entities[index].extend(this_entities)
+                for this_headline, this_entities in zip(these_headlines, these_entities):
+                    these_locations = [{"id": None, "initial": i, "match": i, "type": "GPE"} 
+                                       for i in clean_entities(this_entities, self.norps_gpes)]
+                    # Add locations to geo_tags already found from names
+                    if len(these_locations) > 0:
+                        write_buffer.set(
+                            this_headline["_id"], 
+                            with_derived_fields(
+                                {"geo_tags": this_headline.get("geo_tags", []) + these_locations}))
+                pb.update(len(these_headlines))
+        write_buffer.flush()
+        complete_stage(self.mycol_headlines, query, STAGE_NLP)
+        nlp_cache.evict()
+        print(nlp_cache.stats())
                 
-    # Match headlines with owners names
-    def _match_headlines_owners(self):
-        for owner_name in tqdm(self.owners_names, 
-                               disable = self.ilox_logger.display_pb(), 
-                               desc = "Matching headlines to owners names", 
-                               leave = True):
-            # Get ids of headlines containing current owner_name
-            # Only look for whole word if len of owner_name is less than 8 (e.g. to get RichmondCA)
-            if len(owner_name["match"]) < 8:
-                # For total, search case sensitive for Total and TOTAL
-                if owner_name["initial"] == "Total":
-                    these_ids = [i["_id"] for i in self.mycol_headlines.find(
-                        {"firstCreated": {"$gte": self.headlines_start}, 
-                         "text": {"$regex": "\\b" + owner_name["initial"] + "\\b"}}, 
-                        {"_id": 1})]
-                    these_ids.extend([i["_id"] for i in self.mycol_headlines.find(
-                        {"firstCreated": {"$gte": self.headlines_start}, 
-                         "snippet": {"$regex": "\\b" + owner_name["initial"].upper() + "\\b"}}, 
-                        {"_id": 1})])
-                else:
-                    these_ids = [i["_id"] for i in self.mycol_headlines.find(
-                        {"firstCreated": {"$gte": self.headlines_start}, 
-                         "text": {"$regex": "\\b" + owner_name["match"] + "\\b", "$options": "i"}}, 
-                        {"_id": 1})]
-                    these_ids.extend([i["_id"] for i in self.mycol_headlines.find(
-                        {"firstCreated": {"$gte": self.headlines_start}, 
-                         "snippet": {"$regex": "\\b" + owner_name["match"] + "\\b", "$options": "i"}}, 
-                        {"_id": 1})])
-            else:
-                these_ids = [i["_id"] for i in self.mycol_headlines.find(
-                    {"firstCreated": {"$gte": self.headlines_start}, 
-                     "text": {"$regex": owner_name["match"], "$options": "i"}}, 
-                    {"_id": 1})]
-                these_ids.extend([i["_id"] for i in self.mycol_headlines.find(
-                    {"firstCreated": {"$gte": self.headlines_start}, 
-                     "snippet": {"$regex": owner_name["match"], "$options": "i"}}, 
-                    {"_id": 1})])
-            # Also perform text match using index (accents insensitive) only if owner_name sufficiently 
-            # long as cannot do whole word for index search
-            if len(owner_name["match"]) > 10:
-                these_ids.extend([i["_id"] for i in self.mycol_headlines.find(
-                    {"firstCreated": {"$gte": self.headlines_start}, 
-                     "$text": {"$search": "\"" + owner_name["match"] + "\""}}, 
-                    {"_id": 1})])
-            # Add current owner_name to matching headline's owner_tags field
-            if len(these_ids) > 0:
-                self.mycol_headlines.update_many(
-                    {"_id": {"$in": list(set(these_ids))}}, 
-                    {"$push": {"owner_tags": owner_name}})
-        # Clean matches to keep only long name if short name overlap, e.g. Total and 
-        # Saudi Aramco Total Refining and Petrochemical Company
-        # And also drop duplicates on id
-        headlines_match = [i for i in list(self.mycol_headlines.find(
-            {"firstCreated": {"$gte": self.headlines_start}, 
-             "owner_tags":{"$not": {"$size": 0}}}, 
-            {"owner_tags": 1})) if len(i["owner_tags"]) > 1]
-        for headline in headlines_match:
-            this_df = pd.DataFrame(headline["owner_tags"]).drop_duplicates(subset = ["id", "type"])
-            if len(this_df["initial"].unique()) > 1:
-                overlaps = [i for i in this_df["match"] if len(
-                    [i2 for i2 in this_df["match"] if len(i2) > len(i) and i.lower() in i2.lower()]) > 0]
-                this_df.drop(this_df[this_df["match"].isin(overlaps)].index, inplace = True)
-            self.mycol_headlines.update_one(
-                {"_id": headline["_id"]}, 
-                {"$set": {"owner_tags": this_df.to_dict(orient = "records")}})
-            
     def _match_headlines(self):
-         # Load refineries_file
-         self.refineries_df = pd.read_csv(
-             self.refineries_file)[["GeoAssetID", "GeoAssetName", "City", "FromDate", "ToDate"]]
-         self.refineries_df["FromDate"] = pd.to_datetime(self.refineries_df["FromDate"])
-         # When FromDate is NaT means from infinite
-         self.refineries_df["FromDate"] = self.refineries_df["FromDate"].fillna(
-             pd.to_datetime("1800-01-01"))
-         # When ToDate is NaT means to today
-         self.refineries_df["ToDate"] = pd.to_datetime(self.refineries_df["ToDate"])
-         self.refineries_df["ToDate"] = self.refineries_df["ToDate"].fillna(
-             pd.to_datetime(datetime.utcnow().date()))
-         get_match_proba(self.refineries_df, self.mycol_headlines, self.mycol_refineries, 
-                         self.mycol_gpes, self.geolocator, self.ilox_logger.display_pb(), 
-                         self.headlines_start, "firstCreated", self.nominatim_max_attempts, 
-                         self.nominatim_wait_error, self.nominatim_wait)
+         # Refineries loaded once, shared with other stages
+         registry = self.get_refinery_registry()
+         gpe_cache = self.get_gpe_cache()
+         point_index = self.get_point_index()
+         get_match_proba(registry, self.mycol_headlines, point_index, 
+                         gpe_cache, self.ilox_logger.display_pb(), 
+                         self.headlines_start, "firstCreated", self.write_batch_size, 
+                         pending_filter(self.match_fingerprint, STAGE_REFINERIES), 
+                         {"match_stage": STAGE_REFINERIES}, 
+                         self.ref_match_params["global"]["match_n_workers"], 
+                         self.get_match_worker_params(), self.read_batch_size, 
+                         self.check_query_plans, self.strict_query_plans)
+         print(gpe_cache.stats())
+         print(point_index.stats())
+         complete_stage(self.mycol_headlines, 
+                        {"firstCreated": {"$gte": self.headlines_start}, 
+                         **pending_filter(self.match_fingerprint, STAGE_REFINERIES)}, 
+                        STAGE_REFINERIES)
          
     # Match to country/countries based on ref_match
     def _country_match(self):
-        headlines_match = list(self.mycol_headlines.find(
-            {"firstCreated": {"$gte": self.headlines_start}, "ref_match": {"$not": {"$size": 0}}}, 
-            {"_id": 1, "ref_match": 1}))
-        for this_headline in tqdm(headlines_match, 
-                                  disable = self.ilox_logger.display_pb(), 
-                                  desc = "Matching headlines to countries", 
-                                  leave = True):
-            countries = pd.DataFrame(list(
-                self.mycol_refineries.find(
-                    {"GeoAssetID": {"$in": [i["GeoAssetID"] for i in this_headline["ref_match"]]}}, 
-                    {"country": 1, "_id": 0})))
-            this_match = (countries.country.value_counts()/len(countries)).round(2).to_dict()
-            this_match = pd.DataFrame({"p": this_match}).reset_index(
-                drop = False).rename(columns = {"index": "country"})
-            self.mycol_headlines.update_one(
-                {"_id": this_headline["_id"]}, 
-                {"$set": {"country_match": this_match.to_dict(orient = "records")}})
+        query = {"firstCreated": {"$gte": self.headlines_start}, 
+                 **pending_filter(self.match_fingerprint, STAGE_COUNTRIES)}
+        query_match = {**query, "n_ref_match": {"$gt": 0}}
+        if self.check_query_plans:
+            check_query_plan(self.mycol_headlines, query_match, self.strict_query_plans)
+        # Countries of refineries loaded once, no query per headline
+        registry = self.get_refinery_registry()
+        write_buffer = WriteBuffer(
+            self.mycol_headlines, self.write_batch_size, {"match_stage": STAGE_COUNTRIES})
+        with self.mycol_headlines.find(query_match, {"_id": 1, "ref_match": 1}, 
+                                       batch_size = self.read_batch_size) as headlines_match:
+            for this_headline in tqdm(headlines_match, 
+                                      total = self.mycol_headlines.count_documents(query_match), 
+                                      disable = self.ilox_logger.display_pb(), 
+                                      desc = "Matching headlines to countries", 
+                                      leave = True):
+                write_buffer.set(
+                    this_headline["_id"], 
+                    {"country_match": registry.country_match(
+                        [i["GeoAssetID"] for i in this_headline["ref_match"]])})
+        write_buffer.flush()
+        complete_stage(self.mycol_headlines, query, STAGE_COUNTRIES)
             
     # Extract event types from headlines
     def _match_headlines_event_type(self):
+        # Only headlines with countries matched by current inputs, without events matched yet
+        query = {"firstCreated": {"$gte": self.events_start}, 
+                 "match_fingerprint": self.match_fingerprint, "match_stage": STAGE_COUNTRIES}
         # Get ids of headlines containing current event keyword in text or snippet
         for event_name in tqdm(self.tweets_scraping_params["events_keywords_text"], 
                                disable = self.ilox_logger.display_pb(), 
                                desc = "Matching headlines to event types", 
                                leave = True):
             these_headlines = [i["_id"] for i in self.mycol_headlines.find(
-                {"firstCreated": {"$gte": self.events_start}, 
+                {**query, 
                  "text": {"$regex": "\\b" + event_name + "\\b", "$options": "i"}}, 
                 {"_id": 1})]
             these_headlines.extend([i["_id"] for i in self.mycol_headlines.find(
-                {"firstCreated": {"$gte": self.events_start}, 
+                {**query, 
                  "snippet": {"$regex": "\\b" + event_name + "\\b", "$options": "i"}}, 
                 {"_id": 1})])
             # Add current geo_name to matching Tweet's events_tags field       
             if len(these_headlines) > 0:
                 self.mycol_headlines.update_many(
                     {"_id": {"$in": list(set(these_headlines))}}, 
-                    {"$push": {"events_tags": event_name}})
+                    {"$push": {"events_tags": event_name}, "$set": {"has_events": True}})
         # Drop duplicate match in events_tags field
-        these_headlines = [i for i in self.mycol_headlines.find(
-            {"firstCreated": {"$gte": self.events_start}, 
-             "events_tags": {"$not": {"$size": 0}}}, {"events_tags": 1})]
-        for this_headline in tqdm(these_headlines, 
-                                  disable = True):
-            self.mycol_headlines.update_one(
-                {"_id": this_headline["_id"]}, 
-                {"$set": {"events_tags": list(set(this_headline["events_tags"]))}})
\ No newline at end of file
+        write_buffer = WriteBuffer(
+            self.mycol_headlines, self.write_batch_size, {"match_stage": STAGE_EVENTS})
+        query_events = {**query, "has_events": True}
+        if self.check_query_plans:
+            check_query_plan(self.mycol_headlines, query_events, self.strict_query_plans)
+        with self.mycol_headlines.find(query_events, 
+                                       {"events_tags": 1}, 
+                                       batch_size = self.read_batch_size) as these_headlines:
+            for this_headline in these_headlines:
+                write_buffer.set(
+                    this_headline["_id"], {"events_tags": list(set(this_headline["events_tags"]))})
+        write_buffer.flush()
+        complete_stage(self.mycol_headlines, query, STAGE_EVENTS)
\ No newline at end of file
@@ -5,9 +5,9 @@ Created on Fri Jun 11 01:05:20 2021
 @author: brend
 """
 
-from iLox.twitter_scraper import TwitterWebdriver, TweetsScraper
 import pymongo
 from tqdm import tqdm
+from iLox.dependencies.bulk_writer import BulkWriter
 
 
 class TweetsScraping():
@@ -20,6 +20,7 @@ class TweetsScraping():
         
     # Scrape tweets for all combinations of id and events keywords - hashtags
     def _scrape_tweets_hashtags(self):
+        from iLox.twitter_scraper import TweetsScraper
         # Process all combinations of events keywords and id keywords
         for event_keyword in tqdm(self.tweets_scraping_params["events_keywords_hashtag"], 
                                   disable = self.ilox_logger.display_pb(), 
@@ -31,7 +32,8 @@ class TweetsScraping():
                                               self.webdriver, 
                                               [id_keyword, event_keyword], 
                                               self.tweets_scraping_params["no_replies"], 
-                                              True)
+                                              True, 
+                                              self.pipeline)
                 # Scrape all tweets for those keywords
                 tweetsScraper.scrape_many(self.tweets_scraping_params["max_pages"], 
                                           self.tweets_scraping_params["max_retry_page"], 
@@ -39,6 +41,7 @@ class TweetsScraping():
         
     # Scrape tweets for all combinations of id and events keywords - keywords
     def _scrape_tweets_text(self):
+        from iLox.twitter_scraper import TweetsScraper
         # Process all combinations of events keywords and id keywords
         for event_keyword in tqdm(self.tweets_scraping_params["events_keywords_text"], 
                                   disable = self.ilox_logger.display_pb(), 
@@ -50,13 +53,16 @@ class TweetsScraping():
                                               self.webdriver, 
                                               [id_keyword, event_keyword], 
                                               self.tweets_scraping_params["no_replies"], 
-                                              False)
+                                              False, 
+                                              self.pipeline)
                 # Scrape all tweets for those keywords
                 tweetsScraper.scrape_many(self.tweets_scraping_params["max_pages"], 
                                           self.tweets_scraping_params["max_retry_page"], 
                                           self.tweets_scraping_params["max_retry_scroll"])
         
     def _run(self):
+        # Imported here, Selenium only needed when scraping
+        from iLox.twitter_scraper import TwitterWebdriver, TweetsPipeline
         # If MongoDb collection is empty then create relevant indexes
         if self.mycol_tweets.count_documents({}) == 0:
             self.mycol_tweets.create_index(
@@ -68,12 +74,25 @@ class TweetsScraping():
         self.webdriver = TwitterWebdriver(self.tweets_scraping_params["is_headless"], 
                                           self.tweets_scraping_params["no_gui"], 
                                           self.tweets_scraping_params["webdriver_path"])
-        if self.tweets_scraping_params["hashtag_mode"]:
-            self._scrape_tweets_hashtags()
-        if self.tweets_scraping_params["keywords_mode"]:
-            self._scrape_tweets_hashtags()
-        # Close webdriver
-        self.webdriver.quit()
+        # Tweets of all scrapers decoded and written in background by same pipeline and writer, 
+        # duplicates (already scraped) skipped
+        self.writer = BulkWriter(self.mycol_tweets, background = True)
+        self.pipeline = TweetsPipeline(
+            self.writer, self.tweets_scraping_params["max_pending_responses"])
+        try:
+            if self.tweets_scraping_params["hashtag_mode"]:
+                self._scrape_tweets_hashtags()
+            if self.tweets_scraping_params["keywords_mode"]:
+                self._scrape_tweets_text()
+        finally:
+            # Close webdriver, then wait for Tweets already scraped to be decoded and written
+            self.webdriver.quit()
+            try:
+                self.pipeline.close()
+            finally:
+                self.writer.close()
+        print(self.pipeline.stats())
+        print(self.writer.stats())
                 
                 
                 
@@ -7,5 +7,6 @@ Created on Mon Apr 12 22:37:01 2021
 
 from .twitter_webdriver import TwitterWebdriver
 from .tweets_scraper import TweetsScraper
+from .tweets_pipeline import TweetsPipeline
 
-__all__ = ["TwitterWebdriver", "TweetsScraper"]
\ No newline at end of file
+__all__ = ["TwitterWebdriver", "TweetsScraper", "TweetsPipeline"]
\ No newline at end of file
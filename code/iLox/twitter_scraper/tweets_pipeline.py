@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Jul 28 19:12:40 2021
+
+@author: brend
+"""
+
+import json
+import queue
+import threading
+from iLox.dependencies.item_dates import from_twitter_date
+
+
+class TweetsPipeline():
+
+    def __init__(self, writer, max_pending_responses = 20):
+
+        """
+        Decode Twitter responses and write their Tweets from a background thread, so the thread
+        driving the browser only collects responses bodies and keeps scrolling
+        Args:
+            * writer (BulkWriter): To write the Tweets
+            * max_pending_responses (int): Responses waiting to be decoded, scrapers wait when
+              reached (memory bounded if Tweets are written slower than scraped)
+        """
+
+        self.writer = writer
+        self.n_responses = 0
+        self.n_tweets = 0
+        self._error = None
+        self._queue = queue.Queue(maxsize = max_pending_responses)
+        self._thread = threading.Thread(target = self._process_loop, daemon = True)
+        self._thread.start()
+
+    # Add response body (bytes) of scraper, decoding errors are set in scraper.response_status
+    def put(self, scraper, body):
+        self._raise_error()
+        self._queue.put((scraper, body))
+
+    # Wait until responses added so far are decoded (scrapers response_status up to date)
+    def wait(self):
+        if self._thread is not None:
+            self._queue.join()
+        self._raise_error()
+
+    # Wait until all responses decoded and their Tweets handed to writer, stop background thread
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self._raise_error()
+
+    def _process_loop(self):
+        while True:
+            response = self._queue.get()
+            if response is None:
+                self._queue.task_done()
+                return
+            try:
+                self._process(*response)
+                # Tweets written as soon as nothing else to decode
+                if self._queue.empty():
+                    self.writer.flush()
+            except Exception as e:
+                # Raised in scraping thread on next put, wait or close
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error = self._error
+            self._error = None
+            raise error
+
+    # Extract Tweets from response and send them to writer
+    def _process(self, scraper, body):
+        self.n_responses += 1
+        # If fails to convert body to JSON, scraper reloads page
+        try:
+            these_tweets = json.loads(body.decode("utf-8"))
+        except:
+            scraper.response_status = "json_convert_failed"
+            return
+        # Means triggered error (eg rate limit exceeded), scraper cleans cookies etc and retries
+        if "globalObjects" not in these_tweets.keys():
+            scraper.response_status = "retry_clean"
+            return
+        these_tweets = list(these_tweets["globalObjects"]["tweets"].values())
+        # Dates stored as dates
+        for this_tweet in these_tweets:
+            this_tweet["created_at"] = from_twitter_date(this_tweet["created_at"])
+        self.writer.insert_many(these_tweets)
+        self.n_tweets += len(these_tweets)
+
+    def stats(self):
+        return "Twitter responses: %r decoded, %r Tweets" % (self.n_responses, self.n_tweets)
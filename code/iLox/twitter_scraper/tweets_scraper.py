@@ -6,15 +6,16 @@ Created on Mon Apr 12 23:34:41 2021
 """
 
 import urllib
-import json
-import pymongo
 import time
 import random
+from iLox.dependencies.bulk_writer import BulkWriter
+from iLox.twitter_scraper.tweets_pipeline import TweetsPipeline
 
 
 class TweetsScraper():
     
-    def __init__(self, mycol, webdriver, keywords, no_replies = True, hashtag_mode = True):
+    def __init__(self, mycol, webdriver, keywords, no_replies = True, hashtag_mode = True, 
+                 pipeline = None):
         
         """
         Scrape Tweets by scrolling down pages
@@ -27,6 +28,8 @@ class TweetsScraper():
             * max_retry_scroll (int): Maximum number of attempts to scroll down without receiving new Tweets before considering done
             * no_replies (bool): Only search Tweets not replies
             * hashtag_mode (bool): Search for hashtags of the supplied keywords
+            * pipeline (TweetsPipeline): To decode responses and write the Tweets in background, 
+              can be shared by scrapers (new one on mycol if None, closed after scrape_many)
         """
         
         base_url = "https://twitter.com/search?{}"
@@ -42,21 +45,12 @@ class TweetsScraper():
         self.url = base_url.format(urllib.parse.urlencode(params))
         self.webdriver = webdriver
         self.mycol = mycol
+        self.own_pipeline = pipeline is None
+        self.pipeline = pipeline if pipeline is not None else TweetsPipeline(BulkWriter(mycol))
+        # Set by pipeline when a response can't be decoded (json_convert_failed, retry_clean)
+        self.response_status = "ok"
         
-    # Send multiple MongoDb operations and execute in bulk, skip errors
-    def _bulk_write(self, data):
-        if len(data) == 0:
-            return {}
-        bulk = pymongo.bulk.BulkOperationBuilder(self.mycol, ordered = False)
-        for item in data.copy():
-            bulk.insert(item)
-        try:
-            response = bulk.execute()
-        except pymongo.errors.BulkWriteError:
-            response = {}
-        return response
-        
-    # Extract Tweets from response and save to MongoDb
+    # Send responses to pipeline (decoded and saved to MongoDb in background)
     def _process_requests(self):
         self.status = "ok"
         # Extract requests
@@ -64,27 +58,22 @@ class TweetsScraper():
         # Clear requests cache
         del self.webdriver.requests
         self.len_requests = len(requests)
+        # Waits only if too many responses not decoded yet
+        for r in requests:
+            # No response received yet, reload page
+            if r.response is None:
+                self.response_status = "json_convert_failed"
+                continue
+            self.pipeline.put(self, r.response.body)
+        # Responses sent before failed to decode (known once decoded), reload page
+        if self.response_status != "ok":
+            self.status = self.response_status
+            self.response_status = "ok"
+            return
         # If no new request made by Twitter, means no more tweets pages
         if self.len_requests == 0:
             self.status = "no_requests"
             return
-        self.requests_tweets = []
-        for r in requests:
-            # If fails to convert body to JSON, retry
-            try:
-                these_tweets = json.loads(r.response.body.decode("utf-8"))
-            except:
-                self.status = "json_convert_failed"
-                return
-            # Means triggered error (eg rate limit exceeded), clean cookies etc and retry
-            if "globalObjects" not in these_tweets.keys():
-                self.status = "retry_clean"
-                return
-            these_tweets = list(these_tweets["globalObjects"]["tweets"].values())
-            self.requests_tweets.append(these_tweets)
-            status = self._bulk_write(these_tweets)
-            del status
-        self.status = "ok"
         
     # Scroll page max_pages times, from webdriver currently top of page
     # max_pages = number of pages/views to scrape
@@ -98,6 +87,7 @@ class TweetsScraper():
         self.reload_clean_page = False
         # Loops through tweets pages until max_pages or max_retry_scroll with 0 tweets
         for pages_count in range(max_pages):
+            scroll_time = time.perf_counter()
             self._process_requests()
             # If no requests made then retry scrolling at next iteration and deduct 1 from max_retry_scroll
             if self.status == "no_requests":
@@ -105,6 +95,7 @@ class TweetsScraper():
                 # If max_retry_scroll exceeded then exit
                 if max_retry_scroll == 0:
                     self.complete = True
+                    self._process_last_responses()
                     return
             # If fails to convert body to JSON, reload page
             elif self.status == "json_convert_failed":
@@ -114,9 +105,23 @@ class TweetsScraper():
             elif self.status == "retry_clean":
                 self.reload_clean_page = True
                 return
-            # Otherwise wait random time and scroll down
-            time.sleep(random.randint(2, 4))
+            # Otherwise wait random time (less time spent on this page) and scroll down
+            time.sleep(max(0, random.randint(2, 4) - (time.perf_counter() - scroll_time)))
             self.webdriver.execute_script("window.scrollTo(0, document.body.scrollHeight)")
+        self._process_last_responses()
+
+    # Wait for responses already sent to be decoded, reload page if the last ones failed
+    # (status set after the last page processed, otherwise lost)
+    def _process_last_responses(self):
+        self.pipeline.wait()
+        if self.response_status == "json_convert_failed":
+            self.reload_page = True
+        elif self.response_status == "retry_clean":
+            self.reload_clean_page = True
+        else:
+            return
+        self.response_status = "ok"
+        self.complete = False
     
     # Load initial page and scroll max_pages pages of Tweets for specified criteria
     # max_pages = number of pages/views to scrape
@@ -139,4 +144,8 @@ class TweetsScraper():
                 time.sleep(random.randint(5, 10))
                 self.webdriver.refresh()
             # Otherwise wait random time and retry
-            time.sleep(random.randint(2, 6))
\ No newline at end of file
+            time.sleep(random.randint(2, 6))
+        # Wait for Tweets to be written if pipeline not shared
+        if self.own_pipeline:
+            self.pipeline.close()
+            self.pipeline.writer.close()
\ No newline at end of file
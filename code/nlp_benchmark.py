@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Jul 18 14:26:51 2021
+
+@author: brend
+
+Compare Spacy models and NLP strategies on a labelled sample: docs/sec and GPE recall
+Sample file: one JSON per line, {"text": "Fire at Pernis refinery", "gpes": ["Pernis"]}
+Usage: python nlp_benchmark.py sample.jsonl [--batch_size 256] [--n_process 1]
+"""
+
+import json
+import time
+import argparse
+import pandas as pd
+from iLox.dependencies.spacy_ner import load_ner_model, extract_entities, clean_entities
+from iLox.dependencies.gazetteer_matcher import get_gazetteer_matcher
+
+
+params_file = "iLox_params.json"
+
+
+# Read labelled sample
+def read_sample(sample_file):
+    with open(sample_file, encoding = "utf-8") as f:
+        sample = [json.loads(line) for line in f if len(line.strip()) > 0]
+    return [i["text"] for i in sample], [i["gpes"] for i in sample]
+
+
+# Names found in texts from refineries, cities and owners names (used by tiered strategy)
+def get_known_names(all_params, texts):
+    data_prep_params = all_params["data_preparation"]
+    matcher = get_gazetteer_matcher(
+        [data_prep_params[i] for i in ["geo_names_refineries", "geo_names_cities", "ref_owners_names"]], 
+        data_prep_params["gazetteer_dir"])
+    known_names = []
+    for text in texts:
+        geo_tags, owner_tags = matcher.tags(matcher.match(text))
+        known_names.append([i2 for i in geo_tags + owner_tags
+                            for i2 in [str(i["initial"]), str(i["match"])]])
+    return known_names
+
+
+# Run strategy on all texts, return GPEs found for each text and docs/sec
+def run_strategy(spacy_models, texts, known_names, norps_gpes, strategy, batch_size, n_process):
+    start = time.perf_counter()
+    entities = extract_entities(spacy_models, [i.replace("#", "") for i in texts],
+                                batch_size, n_process, None, strategy, known_names)
+    gpes = [clean_entities(i, norps_gpes, remove_urls = True) for i in entities]
+    return gpes, len(texts) / (time.perf_counter() - start)
+
+
+# Share of labelled GPEs found (case insensitive)
+def gpe_recall(gpes, labels):
+    n_labels = sum([len(set([i.lower() for i in l])) for l in labels])
+    n_found = sum([len(set([i.lower() for i in l]).intersection([i.lower() for i in g]))
+                   for g, l in zip(gpes, labels)])
+    return n_found / max(n_labels, 1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmark NLP strategies on labelled sample")
+    parser.add_argument("sample_file")
+    parser.add_argument("--batch_size", type = int, default = 256)
+    parser.add_argument("--n_process", type = int, default = 1)
+    args = parser.parse_args()
+    with open(params_file) as f:
+        all_params = json.load(f)
+    ref_match_params = all_params["refineries_matching"]
+    model_names = ref_match_params["tweets_matching"]["nlp_models"]
+    norps_gpes = pd.read_csv(ref_match_params["global"]["norps_gpes_file"], encoding = 'cp1252'
+                             ).set_index("NORP")["GPE"].to_dict()
+    texts, labels = read_sample(args.sample_file)
+    print("Loading models ...")
+    spacy_models = {model_name: load_ner_model(model_name) for model_name in model_names}
+    known_names = get_known_names(all_params, texts)
+    # Each model alone, then all models and tiered strategy
+    strategies = [(model_name, [spacy_models[model_name]], "all") for model_name in model_names]
+    strategies.append(("all", list(spacy_models.values()), "all"))
+    strategies.append(("tiered", list(spacy_models.values()), "tiered"))
+    results = []
+    for name, these_models, strategy in strategies:
+        print("Running %s ..." % name)
+        gpes, docs_sec = run_strategy(these_models, texts, known_names, norps_gpes, strategy,
+                                      args.batch_size, args.n_process)
+        results.append({"strategy": name, "docs_sec": round(docs_sec, 1),
+                        "gpe_recall": round(gpe_recall(gpes, labels), 3)})
+    print("\n%r labelled texts" % len(texts))
+    print(pd.DataFrame(results).to_string(index = False))
@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Jul 31 10:12:05 2021
+
+@author: brend
+"""
+
+import os
+import sys
+
+# Tests run from any directory, iLox imported from code directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
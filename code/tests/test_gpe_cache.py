@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Jul 31 11:02:37 2021
+
+@author: brend
+"""
+
+import time
+import threading
+import pytest
+from types import SimpleNamespace
+from iLox.dependencies.gpe_cache import GPECache
+
+mongomock = pytest.importorskip("mongomock")
+geopy_exc = pytest.importorskip("geopy.exc")
+
+
+RATE_PER_SEC = 20.0
+BURST = 2
+
+LYON = {"display_name": "Lyon, France", "lat": "45.76", "lon": "4.83", "importance": 0.8,
+        "geojson": {"type": "Polygon", "coordinates": [[[4.7, 45.7], [4.9, 45.7], [4.9, 45.8],
+                                                        [4.7, 45.8], [4.7, 45.7]]]}}
+
+
+# Nominatim stub recording queries, "Flaky" always unavailable, "Atlantis" never found
+class StubGeolocator():
+
+    def __init__(self):
+        self.queries = []
+        self.lock = threading.Lock()
+
+    def geocode(self, gpe, **kwargs):
+        with self.lock:
+            self.queries.append((gpe, time.monotonic()))
+        if gpe == "Flaky":
+            raise geopy_exc.GeocoderUnavailable("stub")
+        if gpe == "Lyon":
+            return [SimpleNamespace(raw = dict(LYON))]
+        return None
+
+    def count(self, gpe):
+        return len([i for i in self.queries if i[0] == gpe])
+
+
+def get_gpe_cache(mycol_gpes, geolocator):
+    return GPECache(mycol_gpes, geolocator, nominatim_max_attempts = 2, nominatim_wait_error = 0,
+                    nominatim_rate_per_sec = RATE_PER_SEC, nominatim_burst = BURST,
+                    nominatim_max_workers = 4)
+
+
+# Each GPE queried once, within rate limit, GPEs failing all attempts not saved as not_found
+def test_prefetch():
+    mycol_gpes = mongomock.MongoClient().db.gpes
+    geolocator = StubGeolocator()
+    gpe_cache = get_gpe_cache(mycol_gpes, geolocator)
+    gpe_cache.prefetch(["Lyon", "Atlantis", "Lyon", "Flaky", "Atlantis"], display_pb = True)
+    assert geolocator.count("Lyon") == 1
+    assert geolocator.count("Atlantis") == 1
+    assert geolocator.count("Flaky") == 2
+    # Queries in any window within burst + rate (small margin for timer resolution)
+    times = sorted(i[1] for i in geolocator.queries)
+    for i in range(len(times)):
+        for j in range(i + 1, len(times)):
+            assert j - i + 1 <= BURST + (times[j] - times[i]) * RATE_PER_SEC + 0.1
+    assert [i["id"] for i in gpe_cache.get("Lyon")] == [mycol_gpes.find_one({"GPEs": "Lyon"})["_id"]]
+    assert gpe_cache.get("Atlantis") == []
+    assert mycol_gpes.count_documents({"not_found": "Atlantis"}) == 1
+    assert mycol_gpes.count_documents({"not_found": "Flaky"}) == 0
+    # New run: saved GPEs read from collection, failed GPE queried again
+    geolocator.queries = []
+    gpe_cache = get_gpe_cache(mycol_gpes, geolocator)
+    gpe_cache.prefetch(["Lyon", "Atlantis", "Flaky"], display_pb = True)
+    assert geolocator.count("Lyon") == 0
+    assert geolocator.count("Atlantis") == 0
+    assert geolocator.count("Flaky") == 2
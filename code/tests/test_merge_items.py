@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Jul 31 10:24:51 2021
+
+@author: brend
+"""
+
+import pytest
+from datetime import datetime
+from iLox.dependencies.merge_items import prep_merged_col, merge_items
+
+mongomock = pytest.importorskip("mongomock")
+
+
+CONVERT_KEYS = {"firstCreated": "created_at", "storyId": "id", "text": "text",
+                "snippet": "snippet", "cluster_id": "cluster_id"}
+
+
+# Re-merging an unchanged headline keeps cluster_id written by clustering
+def test_merge_keeps_cluster_id():
+    mydb = mongomock.MongoClient().db
+    mydb.headlines.insert_one({"firstCreated": datetime(2021, 7, 14, 10), "storyId": "1",
+                               "text": "Fire at refinery", "snippet": "", "cluster_id": None})
+    prep_merged_col(mydb.merged)
+    merge_items(mydb.headlines, mydb.merged, {}, CONVERT_KEYS)
+    assert mydb.merged.find_one({"id": "1"})["cluster_id"] is None
+    # Clustering output
+    mydb.merged.update_one({"id": "1"}, {"$set": {"cluster_id": "FR-1"}})
+    writer = merge_items(mydb.headlines, mydb.merged, {}, CONVERT_KEYS)
+    assert writer.counts["upserted"] == 0
+    assert mydb.merged.count_documents({}) == 1
+    assert mydb.merged.find_one({"id": "1"})["cluster_id"] == "FR-1"